@@ -0,0 +1,215 @@
+"""
+CPU micro-benchmarks of the asymmetric feedback layers
+    - sign-feedback: backward of sign_symmetry layers with the regular fp32 feedback weight vs. the factored-scale
+        SignFeedback formats (int8, bf16; see functional/sign_feedback.py); reports time per backward pass, speedup,
+        bytes saved for the feedback weight and the relative error of the input gradient
+        (layer shapes of resnet18 with the CIFAR stem and of the classifier of alexnet)
+    - linear: forward + backward of AsymmetricFeedbackLinear (sham, sign_symmetry) vs. nn.Linear on a large batch of
+        token sequences (3-D input)
+    - channels-last: training throughput of an asymmetric feedback ResNet in the NCHW (contiguous) vs. channels_last
+        memory format
+    - concurrent-backward: backward of the sign-feedback layers with grad_input & grad_weight computed sequentially
+        vs. concurrently (see functional/concurrent_backward.py), at a small batch size
+    - momentum-format: short training runs of an asymmetric feedback ResNet (CIFAR stem) with batch manhattan
+        BMNSC_SGD, with fp32 vs. bf16 & fp16 momentum buffers (see optim/stochastic_rounding.py), on a fixed set of
+        random images & labels; reports the loss at the end of the run, the memory of the momentum buffers and the
+        time per step (a quick check; convergence is checked with train.py --momentum-format on CIFAR)
+Usage:
+    python benchmark.py sign-feedback [--batch-size N] [--repeats N] [--threads N]
+    python benchmark.py linear [--batch-size N] [--tokens N] [--in-features N] [--out-features N] [--repeats N]
+    python benchmark.py channels-last [--arch ARCH] [--algo ALGO] [--resolution N] [--batch-size N] [--repeats N]
+    python benchmark.py concurrent-backward [--batch-size N] [--repeats N] [--threads N]
+    python benchmark.py momentum-format [--arch ARCH] [--steps N] [--lr LR] [--batch-size N] [--threads N]
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+import models
+from functional.concurrent_backward import set_concurrent_backward
+from modules.af_conv2d_module import AsymmetricFeedbackConv2d as AFConv2d
+from modules.af_linear_module import AsymmetricFeedbackLinear as AFLinear
+from optim.bm_nsc_sgd import BMNSC_SGD
+
+
+# (name, layer factory, input shape without batch dimension)
+LAYERS = (
+    ('conv 64x64x3x3 @32x32', lambda **kw: AFConv2d(64, 64, 3, padding=1, bias=False, **kw), (64, 32, 32)),
+    ('conv 128x128x3x3 @16x16', lambda **kw: AFConv2d(128, 128, 3, padding=1, bias=False, **kw), (128, 16, 16)),
+    ('conv 256x256x3x3 @8x8', lambda **kw: AFConv2d(256, 256, 3, padding=1, bias=False, **kw), (256, 8, 8)),
+    ('conv 512x512x3x3 @4x4', lambda **kw: AFConv2d(512, 512, 3, padding=1, bias=False, **kw), (512, 4, 4)),
+    ('linear 9216x4096', lambda **kw: AFLinear(9216, 4096, bias=False, **kw), (9216,)),
+    ('linear 4096x4096', lambda **kw: AFLinear(4096, 4096, bias=False, **kw), (4096,)),
+)
+
+
+def time_backward(layer, input, grad_output, repeats):
+    """Returns (seconds per forward + backward pass, input gradient)"""
+    for i in range(repeats + 1):
+        if i == 1:
+            # the first pass is a warmup
+            start = time.perf_counter()
+        input.grad = None
+        for p in layer.parameters():
+            p.grad = None
+        layer(input).backward(grad_output)
+    return (time.perf_counter() - start) / repeats, input.grad.clone()
+
+
+def benchmark_sign_feedback(args):
+    print('{:26s} {:>6s} {:>10s} {:>8s} {:>12s} {:>10s}'.format(
+        'layer', 'format', 'ms/pass', 'speedup', 'feedback MB', 'rel. error'))
+    for name, factory, shape in LAYERS:
+        torch.manual_seed(0)
+        layer = factory(algo='sign_symmetry')
+        input = torch.randn((args.batch_size,) + shape, requires_grad=True)
+        grad_output = torch.randn_like(layer(input))
+        baseline_time, baseline_grad = time_backward(layer, input, grad_output, args.repeats)
+        for fmt in (None, 'int8', 'bf16'):
+            layer.sign_feedback_format = fmt
+            seconds, grad = time_backward(layer, input, grad_output, args.repeats)
+            # bytes of the feedback weight saved for backward
+            feedback_bytes = layer.weight.numel() * (4 if fmt is None else 1 if fmt == 'int8' else 2)
+            error = ((grad - baseline_grad).norm() / baseline_grad.norm()).item()
+            print('{:26s} {:>6s} {:10.2f} {:8.2f} {:12.2f} {:10.1e}'.format(
+                name, str(fmt), seconds * 1e3, baseline_time / seconds, feedback_bytes / 2 ** 20, error))
+
+
+def benchmark_linear(args):
+    print('{:26s} {:>10s} {:>12s} {:>10s}'.format('layer', 'ms/pass', 'tokens/s', 'vs Linear'))
+    torch.manual_seed(0)
+    input = torch.randn(args.batch_size, args.tokens, args.in_features, requires_grad=True)
+    grad_output = torch.randn(args.batch_size, args.tokens, args.out_features)
+    linear = nn.Linear(args.in_features, args.out_features)
+    baseline_time, _ = time_backward(linear, input, grad_output, args.repeats)
+    for name, layer in (('nn.Linear', linear),
+                        ('AF linear (sham)', AFLinear(args.in_features, args.out_features, algo='sham')),
+                        ('AF linear (sign_symmetry)', AFLinear(args.in_features, args.out_features))):
+        seconds, _ = time_backward(layer, input, grad_output, args.repeats)
+        print('{:26s} {:10.2f} {:12.0f} {:10.2f}'.format(
+            name, seconds * 1e3, args.batch_size * args.tokens / seconds, seconds / baseline_time))
+
+
+def benchmark_channels_last(args):
+    print('{:16s} {:>10s} {:>10s} {:>8s}'.format('memory format', 'ms/step', 'images/s', 'speedup'))
+    torch.manual_seed(0)
+    model = models.__dict__[args.arch](af_algo=args.algo, stem='imagenet' if args.resolution > 64 else 'cifar')
+    input = torch.randn(args.batch_size, 3, args.resolution, args.resolution)
+    target = torch.randint(1000, (args.batch_size,))
+    criterion = nn.CrossEntropyLoss()
+    baseline_time = None
+    for name, memory_format in (('contiguous', torch.contiguous_format), ('channels_last', torch.channels_last)):
+        model = model.to(memory_format=memory_format)
+        step_input = input.contiguous(memory_format=memory_format)
+        for i in range(args.repeats + 1):
+            if i == 1:
+                # the first step is a warmup
+                start = time.perf_counter()
+            model.zero_grad(set_to_none=True)
+            criterion(model(step_input), target).backward()
+        seconds = (time.perf_counter() - start) / args.repeats
+        baseline_time = baseline_time or seconds
+        print('{:16s} {:10.2f} {:10.1f} {:8.2f}'.format(
+            name, seconds * 1e3, args.batch_size / seconds, baseline_time / seconds))
+
+
+def benchmark_concurrent_backward(args):
+    print('{:26s} {:>14s} {:>14s} {:>8s} {:>10s}'.format(
+        'layer', 'sequential ms', 'concurrent ms', 'speedup', 'rel. error'))
+    for name, factory, shape in LAYERS:
+        torch.manual_seed(0)
+        layer = factory(algo='sign_symmetry')
+        input = torch.randn((args.batch_size,) + shape, requires_grad=True)
+        grad_output = torch.randn_like(layer(input))
+        sequential_time, sequential_grad = time_backward(layer, input, grad_output, args.repeats)
+        set_concurrent_backward(True)
+        concurrent_time, concurrent_grad = time_backward(layer, input, grad_output, args.repeats)
+        set_concurrent_backward(False)
+        error = ((concurrent_grad - sequential_grad).norm() / sequential_grad.norm()).item()
+        print('{:26s} {:14.2f} {:14.2f} {:8.2f} {:10.1e}'.format(
+            name, sequential_time * 1e3, concurrent_time * 1e3, sequential_time / concurrent_time, error))
+
+
+def benchmark_momentum_format(args):
+    print('{:8s} {:>10s} {:>12s} {:>10s}'.format('format', 'loss', 'momentum MB', 'ms/step'))
+    torch.manual_seed(0)
+    inputs = torch.randn(4, args.batch_size, 3, 32, 32)
+    targets = torch.randint(10, (4, args.batch_size))
+    criterion = nn.CrossEntropyLoss()
+    for fmt in (None, 'bf16', 'fp16'):
+        torch.manual_seed(0)
+        model = models.__dict__[args.arch](af_algo='sign_symmetry', stem='cifar', num_classes=10)
+        optimizer = BMNSC_SGD(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=1e-4,
+                              batch_manhattan=True, momentum_format=fmt)
+        losses = []
+        start = time.perf_counter()
+        for step in range(args.steps):
+            loss = criterion(model(inputs[step % 4]), targets[step % 4])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        seconds = (time.perf_counter() - start) / args.steps
+        momentum_bytes = sum(state['momentum_buffer'].numel() * state['momentum_buffer'].element_size()
+                             for state in optimizer.state.values())
+        # averaged over the last pass over the 4 batches
+        print('{:8s} {:10.4f} {:12.2f} {:10.1f}'.format(
+            str(fmt), sum(losses[-4:]) / 4, momentum_bytes / 2 ** 20, seconds * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU micro-benchmarks of the asymmetric feedback layers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sign_parser = subparsers.add_parser('sign-feedback', help='factored-scale sign_symmetry backward')
+    linear_parser = subparsers.add_parser('linear', help='AsymmetricFeedbackLinear vs. nn.Linear on token batches')
+    linear_parser.add_argument('--tokens', default=512, type=int, metavar='N',
+                               help='number of tokens per sequence (default: 512)')
+    linear_parser.add_argument('--in-features', default=1024, type=int, metavar='N',
+                               help='input features (default: 1024)')
+    linear_parser.add_argument('--out-features', default=4096, type=int, metavar='N',
+                               help='output features (default: 4096)')
+    channels_last_parser = subparsers.add_parser('channels-last', help='ResNet training step in NCHW vs. NHWC')
+    channels_last_parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
+                                      help='asymmetric feedback resnet (default: resnet18)')
+    channels_last_parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
+                                      help='asymmetric feedback algorithm (default: sign_symmetry)')
+    channels_last_parser.add_argument('--resolution', default=224, type=int, metavar='N',
+                                      help='input resolution; the imagenet stem is used above 64 (default: 224)')
+    concurrent_parser = subparsers.add_parser('concurrent-backward',
+                                              help='sequential vs. concurrent grad_input & grad_weight')
+    concurrent_parser.set_defaults(batch_size=4)
+    momentum_parser = subparsers.add_parser('momentum-format', help='fp32 vs. bf16 & fp16 momentum buffers')
+    momentum_parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
+                                 help='asymmetric feedback resnet (default: resnet18)')
+    momentum_parser.add_argument('--steps', default=100, type=int, metavar='N',
+                                 help='number of training steps per format (default: 100)')
+    momentum_parser.add_argument('--lr', default=1e-3, type=float, metavar='LR',
+                                 help='learning rate (default: 1e-3)')
+    for subparser in (sign_parser, linear_parser, channels_last_parser, concurrent_parser, momentum_parser):
+        subparser.add_argument('-b', '--batch-size', default=32, type=int, metavar='N',
+                               help='mini-batch size (default: 32)')
+        subparser.add_argument('--repeats', default=10, type=int, metavar='N',
+                               help='number of timed passes per configuration (default: 10)')
+        subparser.add_argument('--threads', default=None, type=int, metavar='N',
+                               help='number of CPU threads (default: torch default)')
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.command == 'sign-feedback':
+        benchmark_sign_feedback(args)
+    elif args.command == 'linear':
+        benchmark_linear(args)
+    elif args.command == 'channels-last':
+        benchmark_channels_last(args)
+    elif args.command == 'concurrent-backward':
+        benchmark_concurrent_backward(args)
+    elif args.command == 'momentum-format':
+        benchmark_momentum_format(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Cache of the penultimate features of a frozen model, for training last layers without running the backbone
+    - extract_features() runs the model once over a loader and stores the inputs of its last layer (flattened) in a
+        .npy file, with the targets in another; files are written to temporary names and renamed when complete, so
+        that an interrupted extraction is not mistaken for a cache
+    - FeatureCache memory-maps the files, so that datasets larger than memory can be used and, once in the page
+        cache, batches are read at memory bandwidth; shuffled batches read their rows in increasing order
+    - features can be stored in fp16, halving the file size; batches are converted to fp32 on the device
+"""
+
+import os
+
+import numpy as np
+import torch
+
+
+FEATURE_DTYPES = {'fp16': np.float16, 'fp32': np.float32}
+
+
+def _paths(prefix):
+    return prefix + '_features.npy', prefix + '_targets.npy'
+
+
+def cache_exists(prefix):
+    return all(os.path.exists(path) for path in _paths(prefix))
+
+
+def extract_features(model, layer, loader, prefix, feature_format='fp16', device='cpu'):
+    """Stores the inputs of layer (a module of model) for the batches of loader, without shuffling, at prefix (see
+    _paths()) and returns the FeatureCache"""
+    captured = []
+    handle = layer.register_forward_pre_hook(lambda module, input: captured.append(input[0]))
+    features = targets = None
+    paths = [path[:-len('.npy')] + '.tmp.npy' for path in _paths(prefix)]
+    start = 0
+    try:
+        model.eval()
+        with torch.no_grad():
+            for input, target in loader:
+                captured.clear()
+                model(input.to(device))
+                batch = captured[0].flatten(1)
+                if features is None:
+                    features = np.lib.format.open_memmap(paths[0], mode='w+', dtype=FEATURE_DTYPES[feature_format],
+                                                         shape=(len(loader.dataset), batch.size(1)))
+                    targets = np.lib.format.open_memmap(paths[1], mode='w+', dtype=np.int64,
+                                                        shape=(len(loader.dataset),))
+                features[start:start + len(batch)] = batch.cpu().numpy()
+                targets[start:start + len(batch)] = target.numpy()
+                start += len(batch)
+    finally:
+        handle.remove()
+    if features is None:
+        raise RuntimeError('no features were extracted: the loader yielded no batches')
+    # a loader dropping its last batch or sampling a subset would leave rows of the files unwritten
+    assert start == len(loader.dataset), \
+        'features were extracted for {} of {} samples'.format(start, len(loader.dataset))
+    features.flush()
+    targets.flush()
+    del features, targets
+    for path, final_path in zip(paths, _paths(prefix)):
+        os.replace(path, final_path)
+    return FeatureCache(prefix)
+
+
+class FeatureCache(object):
+    def __init__(self, prefix, in_memory=False):
+        """Opens the cache at prefix; with in_memory, features are read into memory instead of memory-mapped"""
+        features_path, targets_path = _paths(prefix)
+        self.features = np.load(features_path, mmap_mode=None if in_memory else 'r')
+        self.targets = np.load(targets_path)
+
+    def __len__(self):
+        return len(self.targets)
+
+    @property
+    def num_features(self):
+        return self.features.shape[1]
+
+    @property
+    def num_classes(self):
+        return int(self.targets.max()) + 1
+
+    def batches(self, batch_size, shuffle=False, generator=None, device='cpu'):
+        """Yields (features, target) batches on device, features in fp32"""
+        order = torch.randperm(len(self), generator=generator).numpy() if shuffle else None
+        for start in range(0, len(self), batch_size):
+            if shuffle:
+                index = np.sort(order[start:start + batch_size])
+                features, targets = self.features[index], self.targets[index]
+            else:
+                # copied out of the (read-only) memory map
+                features = np.array(self.features[start:start + batch_size])
+                targets = np.array(self.targets[start:start + batch_size])
+            # converted after the copy, which transfers fp16 features at half the size
+            yield torch.from_numpy(features).to(device).float(), torch.from_numpy(targets).to(device)
@@ -0,0 +1,112 @@
+"""
+Background prefetching of batches from a DataLoader
+    - a thread iterates the loader and, for each batch, copies it to the target device (on a separate CUDA stream)
+        and optionally normalizes it there, so that data transfer & normalization overlap with compute
+    - prepared batches are handed over through a bounded queue, which limits the extra memory used
+    - the number of batches for which the queue was empty (i.e. compute waited for data) and the time waited are
+        recorded, to help size the number of data loading workers
+"""
+
+import queue
+import threading
+import time
+
+import torch
+
+
+class Prefetcher(object):
+    def __init__(self, loader, device=None, mean=None, std=None, queue_size=2):
+        """
+        Args:
+            loader (DataLoader): yields (input, target) batches
+            device (str or torch.device): device to copy batches to; None keeps them where the loader puts them
+            mean, std (sequence): if given, input is normalized per channel on device
+            queue_size (int): maximum number of prepared batches waiting to be consumed
+        """
+        self.loader = loader
+        self.device = None if device is None else torch.device(device)
+        self.mean = self.std = None
+        if mean is not None:
+            self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+            self.std = torch.tensor(std).view(1, -1, 1, 1)
+            if self.device is not None:
+                self.mean = self.mean.to(self.device)
+                self.std = self.std.to(self.device)
+        self.queue_size = queue_size
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_stats(self):
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+
+    def stats(self):
+        return 'starved on {} of {} batches, waited {:.2f}s for data'.format(
+            self.starved, self.batches, self.wait_time)
+
+    def __iter__(self):
+        self.reset_stats()
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                starved = batches.empty()
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                input, target, ready = item
+                if ready is not None:
+                    # wait for the copy on the side stream, and keep the memory from being reused under it
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(ready)
+                    input.record_stream(stream)
+                    target.record_stream(stream)
+                self.wait_time += time.time() - start
+                self.starved += starved
+                self.batches += 1
+                yield input, target
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _produce(self, batches, stop):
+        use_cuda = self.device is not None and self.device.type == 'cuda'
+        stream = torch.cuda.Stream(self.device) if use_cuda else None
+        try:
+            for input, target in self.loader:
+                if stop.is_set():
+                    return
+                ready = None
+                if use_cuda:
+                    with torch.cuda.stream(stream):
+                        input, target = self._prepare(input, target)
+                        ready = torch.cuda.Event()
+                        ready.record(stream)
+                else:
+                    input, target = self._prepare(input, target)
+                batches.put((input, target, ready))
+        except BaseException as e:
+            batches.put(e)
+            return
+        batches.put(None)
+
+    def _prepare(self, input, target):
+        if self.device is not None:
+            input = input.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
+        if self.mean is not None:
+            input = input.sub(self.mean).div_(self.std)
+        return input, target
@@ -0,0 +1,62 @@
+"""
+Sampling & data augmentation that can be resumed from any batch of an epoch
+    - ResumableSampler shuffles deterministically from (seed, epoch), like DistributedSampler, and can start an
+        epoch at any position
+    - along with each index it yields a per-sample seed derived from (seed, epoch, rank, position); SeededDataset
+        seeds the RNGs with it before loading the sample, so random augmentations do not depend on the state of the
+        data loading workers, which cannot be saved & restored
+"""
+
+import random
+
+import torch
+import torch.utils.data
+
+
+class ResumableSampler(torch.utils.data.DistributedSampler):
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        # num_replicas & rank are given explicitly, so that torch.distributed is not needed for a single process
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        """Starts epoch epoch at its start_index-th sample (of this replica)"""
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start_index = start_index
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        for position in range(self.start_index, len(indices)):
+            yield indices[position], self.sample_seed(position)
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def sample_seed(self, position):
+        return hash((self.seed, self.epoch, self.rank, position)) % 2 ** 63
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    """Wraps dataset to be indexed by the (index, seed) pairs yielded by ResumableSampler"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        index, seed = item
+        if torch.utils.data.get_worker_info() is not None:
+            random.seed(seed)
+            torch.manual_seed(seed)
+            return self.dataset[index]
+
+        # loading in the main process: leave its RNG states untouched
+        python_state = random.getstate()
+        with torch.random.fork_rng(devices=[]):
+            random.seed(seed)
+            torch.manual_seed(seed)
+            sample = self.dataset[index]
+        random.setstate(python_state)
+        return sample
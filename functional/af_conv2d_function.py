@@ -1,83 +1,95 @@
 """
 A conv2d autograd Function that supports different feedforward and feedback weights
-Uses the same C functions used in the legacy SpatialConvolution module to implement actual computation
+The forward pass is a regular conv2d (including dilation and groups, e.g. depthwise); the backward pass uses the
+convolution gradient routines in torch.nn.grad, so that the input gradient can be computed with the feedback weight
+instead of the feedforward weight
+Tensors keep their memory format: with channels_last input and weights (e.g. model.to(memory_format=
+torch.channels_last)), output and gradients are channels_last, without layout conversions
+Only what each enabled gradient needs is saved for backward:
+    - grad_input needs weight_feedback (and the input shape), or only its seed if it is a RegeneratedFeedback,
+        or only its low precision sign & scale if it is a SignFeedback
+    - grad_weight needs input (optionally stored in reduced precision, see saved_input.py)
+    - grad_bias needs nothing but grad_output
+grad_input and grad_weight may be computed concurrently on CPU, see concurrent_backward.py
 References:
     - https://github.com/L0SG/feedback-alignment-pytorch/blob/master/lib/fa_linear.py
     - https://pytorch.org/docs/master/notes/extending.html
-    - torch/legacy/nn/SpatialConvolution.py
 """
 
+import torch
 import torch.autograd as autograd
-from torch._thnn import type2backend
+import torch.nn.functional as F
+from torch.nn.grad import conv2d_input, conv2d_weight
+from functional.concurrent_backward import run_backward
+from functional.regenerated_feedback import RegeneratedFeedback
+from functional.saved_input import compress, decompress
+from functional.sign_feedback import SignFeedback, compute_dtype
 
 
 class AsymmetricFeedbackConv2dFunc(autograd.Function):
 
     @staticmethod
-    def forward(context, input, weight, weight_feedback, bias, stride, padding):
-        _backend = type2backend[input.type()]
-        input = input.contiguous()
-        output = input.new()
-        finput = input.new()
-        fgradInput = input.new()
+    def forward(context, input, weight, weight_feedback, bias, stride, padding, dilation=1, groups=1,
+                saved_input_format=None):
+        output = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
 
-        _backend.SpatialConvolutionMM_updateOutput(
-            _backend.library_state,
-            input,
-            output,
-            weight,
-            bias,
-            finput,
-            fgradInput,
-            weight.shape[2], weight.shape[3],
-            int(stride[0]), int(stride[1]),
-            int(padding[0]), int(padding[1])
-        )
-
-        context.save_for_backward(input, weight, weight_feedback, bias, stride, padding, finput, fgradInput)
+        saved_input = input_scale = None
+        if context.needs_input_grad[1]:
+            saved_input, input_scale = compress(input, saved_input_format)
+        # a RegeneratedFeedback only keeps a seed; the feedback weight is generated in backward
+        context.regenerated_feedback = None
+        if isinstance(weight_feedback, RegeneratedFeedback):
+            context.regenerated_feedback, weight_feedback = weight_feedback, None
+        # a SignFeedback is saved as its sign; the scale is applied to the computed input gradient
+        context.feedback_scale = context.feedback_format = None
+        if isinstance(weight_feedback, SignFeedback):
+            context.feedback_scale, context.feedback_format = weight_feedback.scale, weight_feedback.format
+            weight_feedback = weight_feedback.sign
+        if not context.needs_input_grad[0]:
+            weight_feedback = context.regenerated_feedback = None
+        context.save_for_backward(saved_input, input_scale, weight_feedback)
+        context.weight_dtype = weight.dtype
+        context.input_shape = input.shape
+        context.input_dtype = input.dtype
+        context.weight_shape = weight.shape
+        context.channels_last = weight.dim() == 4 and not weight.is_contiguous() and \
+            weight.is_contiguous(memory_format=torch.channels_last)
+        context.stride = stride
+        context.padding = padding
+        context.dilation = dilation
+        context.groups = groups
         return output
 
     @staticmethod
     def backward(context, grad_output):
-        input, weight, weight_feedback, bias, stride, padding, finput, fgradInput = context.saved_variables
-        grad_input = grad_weight = grad_bias = None
-
-        _backend = type2backend[grad_output.type()]
-        grad_output = grad_output.contiguous()
-        ksize = tuple(weight.shape[-2:])
+        saved_input, input_scale, weight_feedback = context.saved_tensors
+        grad_bias = None
 
-        if context.needs_input_grad[0]:
-            grad_input = input.new()
+        def compute_grad_input():
+            feedback = weight_feedback
+            if context.regenerated_feedback is not None:
+                feedback = context.regenerated_feedback.generate(grad_output.device, context.weight_dtype)
+                if context.channels_last:
+                    feedback = feedback.contiguous(memory_format=torch.channels_last)
+            if context.feedback_scale is not None:
+                dtype = compute_dtype(context.feedback_format, grad_output.dtype)
+                grad_input = conv2d_input(context.input_shape, feedback.to(dtype), grad_output.to(dtype),
+                                          context.stride, context.padding, context.dilation, context.groups)
+                return grad_input.to(grad_output.dtype).mul_(context.feedback_scale)
+            return conv2d_input(context.input_shape, feedback, grad_output,
+                                context.stride, context.padding, context.dilation, context.groups)
 
-            _backend.SpatialConvolutionMM_updateGradInput(
-                _backend.library_state,
-                input,
-                grad_output,
-                grad_input,
-                weight_feedback,
-                finput,
-                fgradInput,
-                ksize[0], ksize[1],
-                int(stride[0]), int(stride[1]),
-                int(padding[0]), int(padding[1])
-            )
+        def compute_grad_weight():
+            input = decompress(saved_input, input_scale, context.input_dtype)
+            return conv2d_weight(input, context.weight_shape, grad_output,
+                                 context.stride, context.padding, context.dilation, context.groups)
 
-        if context.needs_input_grad[1] or context.needs_input_grad[3]:
-            grad_weight = weight.grad or weight.new_zeros(weight.shape)
-            grad_bias = None if bias is None else bias.grad or bias.new_zeros(bias.shape)
+        # grad_input is not needed for the first layer, whose input does not require grad
+        grad_input, grad_weight = run_backward(compute_grad_input if context.needs_input_grad[0] else None,
+                                               compute_grad_weight if context.needs_input_grad[1] else None,
+                                               grad_output.device)
 
-            _backend.SpatialConvolutionMM_accGradParameters(
-                _backend.library_state,
-                input,
-                grad_output,
-                grad_weight,
-                grad_bias,
-                finput,
-                fgradInput,
-                ksize[0], ksize[1],
-                int(stride[0]), int(stride[1]),
-                int(padding[0]), int(padding[1]),
-                1
-            )
+        if context.needs_input_grad[3]:
+            grad_bias = grad_output.sum((0, 2, 3))
 
-        return grad_input, grad_weight, None, grad_bias, None, None
+        return grad_input, grad_weight, None, grad_bias, None, None, None, None, None
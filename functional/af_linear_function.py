@@ -1,36 +1,83 @@
 """
 Adopted from https://github.com/L0SG/feedback-alignment-pytorch/blob/master/lib/fa_linear.py
+    - input may have any number of leading batch dimensions (e.g. (batch, tokens, features)); they are flattened
+        into views, without copies for contiguous input
+    - the bias is added by addmm in the matrix multiplication itself, and its gradient is a single reduction over
+        all leading dimensions
 """
 
 
+import torch
 from torch import autograd
+from functional.concurrent_backward import run_backward
+from functional.regenerated_feedback import RegeneratedFeedback
+from functional.saved_input import compress, decompress
+from functional.sign_feedback import SignFeedback, compute_dtype
 
 
 class AsymmetricFeedbackLinearFunc(autograd.Function):
 
     @staticmethod
     # same as reference linear function, but with additional fa tensor for backward
-    def forward(context, input, weight, weight_feedback, bias=None):
-        context.save_for_backward(input, weight, weight_feedback, bias)
-        output = input.mm(weight.t())
+    def forward(context, input, weight, weight_feedback, bias=None, saved_input_format=None):
+        # only save what the enabled gradients need: input for grad_weight, weight_feedback for grad_input
+        saved_input = input_scale = None
+        if context.needs_input_grad[1]:
+            saved_input, input_scale = compress(input, saved_input_format)
+        # a RegeneratedFeedback only keeps a seed; the feedback weight is generated in backward
+        context.regenerated_feedback = None
+        if isinstance(weight_feedback, RegeneratedFeedback):
+            context.regenerated_feedback, weight_feedback = weight_feedback, None
+        # a SignFeedback is saved as its sign; the scale is applied to the computed input gradient
+        context.feedback_scale = context.feedback_format = None
+        if isinstance(weight_feedback, SignFeedback):
+            context.feedback_scale, context.feedback_format = weight_feedback.scale, weight_feedback.format
+            weight_feedback = weight_feedback.sign
+        if not context.needs_input_grad[0]:
+            weight_feedback = context.regenerated_feedback = None
+        context.save_for_backward(saved_input, input_scale, weight_feedback)
+        context.weight_dtype = weight.dtype
+        context.input_dtype = input.dtype
+        context.input_shape = input.shape
+
+        input_2d = input.reshape(-1, input.size(-1))
         if bias is not None:
-            output += bias.unsqueeze(0).expand_as(output)
-        return output
+            output = torch.addmm(bias, input_2d, weight.t())
+        else:
+            output = input_2d.mm(weight.t())
+        return output.view(input.shape[:-1] + (weight.size(0),))
 
     @staticmethod
     def backward(context, grad_output):
-        input, weight, weight_fa, bias = context.saved_variables
-        grad_input = grad_weight = grad_weight_fa = grad_bias = None
+        saved_input, input_scale, weight_fa = context.saved_tensors
+        grad_weight_fa = grad_bias = None
+        grad_output = grad_output.reshape(-1, grad_output.size(-1))
 
-        if context.needs_input_grad[0]:
+        def compute_grad_input():
+            feedback = weight_fa
+            if context.regenerated_feedback is not None:
+                feedback = context.regenerated_feedback.generate(grad_output.device, context.weight_dtype)
             # all of the logic of FA resides in this one line
             # calculate the gradient of input with fixed fa tensor, rather than the "correct" model weight
-            grad_input = grad_output.mm(weight_fa)
-        if context.needs_input_grad[1]:
+            if context.feedback_scale is not None:
+                dtype = compute_dtype(context.feedback_format, grad_output.dtype)
+                grad_input = grad_output.to(dtype).mm(feedback.to(dtype))
+                grad_input = grad_input.to(grad_output.dtype).mul_(context.feedback_scale)
+            else:
+                grad_input = grad_output.mm(feedback)
+            return grad_input.view(context.input_shape)
+
+        def compute_grad_weight():
             # grad for weight with FA'ed grad_output from downstream layer
             # it is same with original linear function
-            grad_weight = grad_output.t().mm(input)
-        if bias is not None and context.needs_input_grad[3]:
-            grad_bias = grad_output.sum(0).squeeze(0)
+            input = decompress(saved_input, input_scale, context.input_dtype)
+            return grad_output.t().mm(input.reshape(-1, input.size(-1)))
+
+        # independent, so they may be computed concurrently (see concurrent_backward.py)
+        grad_input, grad_weight = run_backward(compute_grad_input if context.needs_input_grad[0] else None,
+                                               compute_grad_weight if context.needs_input_grad[1] else None,
+                                               grad_output.device)
+        if context.needs_input_grad[3]:
+            grad_bias = grad_output.sum(0)
 
-        return grad_input, grad_weight, grad_weight_fa, grad_bias
+        return grad_input, grad_weight, grad_weight_fa, grad_bias, None
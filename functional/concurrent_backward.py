@@ -0,0 +1,60 @@
+"""
+Concurrent computation of the input and weight gradients in the backward passes of the asymmetric feedback Functions
+    - grad_input (with the feedback weight) and grad_weight (with the saved input) are independent; once enabled with
+        set_concurrent_backward(True), grad_weight is computed by a worker thread while the calling thread computes
+        grad_input, each with its share of the intra-op threads
+    - this helps when a single convolution does not keep all cores busy (small batches, many cores)
+    - only CPU backward passes are run concurrently: on CUDA, kernels are already asynchronous, and a worker thread
+        would not use the current stream of the calling thread
+"""
+
+import concurrent.futures
+
+import torch
+
+
+_executor = None
+_num_threads = None
+
+
+def set_concurrent_backward(enabled, num_threads=None):
+    """Enables or disables concurrent backward passes; num_threads (default: torch.get_num_threads()) intra-op
+    threads are split between the two gradients"""
+    global _executor, _num_threads
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    if enabled:
+        _executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='af_backward')
+        _num_threads = num_threads
+
+
+def is_concurrent_backward_enabled():
+    return _executor is not None
+
+
+def _run_with_threads(compute, num_threads, grad_enabled):
+    torch.set_num_threads(num_threads)
+    with torch.set_grad_enabled(grad_enabled):
+        return compute()
+
+
+def run_backward(compute_grad_input, compute_grad_weight, device):
+    """Returns (compute_grad_input(), compute_grad_weight()), computed concurrently if enabled; either function may
+    be None if its gradient is not needed, in which case None is returned for it"""
+    if _executor is None or compute_grad_input is None or compute_grad_weight is None or device.type != 'cpu':
+        return (compute_grad_input() if compute_grad_input is not None else None,
+                compute_grad_weight() if compute_grad_weight is not None else None)
+
+    num_threads = torch.get_num_threads()
+    input_threads = max(1, (_num_threads or num_threads) // 2)
+    weight_threads = max(1, (_num_threads or num_threads) - input_threads)
+    future = _executor.submit(_run_with_threads, compute_grad_weight, weight_threads, torch.is_grad_enabled())
+    torch.set_num_threads(input_threads)
+    try:
+        grad_input = compute_grad_input()
+    finally:
+        torch.set_num_threads(num_threads)
+        # waits for the worker even if grad_input failed
+        grad_weight = future.result()
+    return grad_input, grad_weight
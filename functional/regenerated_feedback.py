@@ -0,0 +1,69 @@
+"""
+Fixed random feedback weights that are regenerated from a seed instead of being stored
+    - with feedback_alignment, the feedback weight of a layer is fully determined by (seed, shape, distribution,
+        scale); RegeneratedFeedback holds only these and generates the weight in the backward pass, when the input
+        gradient is computed, so that it does not occupy device memory for the whole run
+    - values come from a counter-based generator: a hash of (seed, element index) computed with integer tensor ops
+        on the seed tensor's device, so generating neither depends on nor advances any RNG state, and never
+        synchronizes with the host; the weight is bit-identical at every step, on every rank (on the same kind of
+        device) and for any chunk size
+    - the weight is generated in chunks of chunk_size elements, which bounds the memory of the int64 temporaries
+        for large layers (e.g. the 9216x4096 first classifier layer of AlexNet)
+"""
+
+import math
+import torch
+
+
+DISTRIBUTIONS = ('normal', 'uniform')
+
+_MASK = 0xffffffff
+
+
+def _hash32(x):
+    # integer hash of 32-bit values held in int64 tensors; products stay below 2 ** 63
+    x = x ^ (x >> 16)
+    x = (x * 0x21f0aaad) & _MASK
+    x = x ^ (x >> 15)
+    x = (x * 0x735a2d97) & _MASK
+    return x ^ (x >> 15)
+
+
+def _uniform(counter, key0, key1):
+    # uniform in (0, 1) from the top 24 bits of the hash, exact in float32
+    bits = _hash32(_hash32(counter ^ key0) ^ key1) >> 8
+    return (bits.float() + 0.5) * 2 ** -24
+
+
+class RegeneratedFeedback(object):
+    """A feedback weight of shape shape, drawn from N(0, scale ** 2) ('normal') or U(-scale, scale) ('uniform'),
+    determined by the int64 scalar tensor seed"""
+
+    def __init__(self, seed, shape, distribution, scale, chunk_size=2 ** 20):
+        assert distribution in DISTRIBUTIONS, 'distribution %s is not supported' % distribution
+        self.seed = seed
+        self.shape = torch.Size(shape)
+        self.distribution = distribution
+        self.scale = scale
+        self.chunk_size = chunk_size
+
+    def generate(self, device=None, dtype=None):
+        seed = self.seed.to(device=device, dtype=torch.int64)
+        key0 = _hash32(seed & _MASK)
+        key1 = _hash32(((seed >> 32) & _MASK) ^ key0)
+        numel = self.shape.numel()
+        # normal values take two uniform values (Box-Muller): counters 2i and 2i + 1
+        draws = 2 if self.distribution == 'normal' else 1
+        assert numel * draws <= _MASK + 1, 'feedback weight with %d elements is too large' % numel
+
+        weight = torch.empty(numel, dtype=dtype, device=seed.device)
+        for start in range(0, numel, self.chunk_size):
+            index = torch.arange(start, min(start + self.chunk_size, numel), dtype=torch.int64, device=seed.device)
+            if self.distribution == 'normal':
+                u0 = _uniform(index * 2, key0, key1)
+                u1 = _uniform(index * 2 + 1, key0, key1)
+                values = torch.sqrt(-2 * torch.log(u0)) * torch.cos(2 * math.pi * u1) * self.scale
+            else:
+                values = (_uniform(index, key0, key1) * 2 - 1) * self.scale
+            weight[start:start + len(index)] = values
+        return weight.view(self.shape)
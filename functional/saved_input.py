@@ -0,0 +1,37 @@
+"""
+Storage formats for the input activation that the asymmetric feedback Functions save for backward
+    - None: the input is saved as is
+    - 'bf16': the input is saved as torch.bfloat16
+    - 'int8': the input is saved as torch.int8 with a symmetric per-sample scale
+The saved input is only used to compute the weight gradient, so the input gradient (and hence the feedback
+signal sent to lower layers) is unaffected by the storage format
+"""
+
+import torch
+
+
+SAVED_INPUT_FORMATS = (None, 'bf16', 'int8')
+
+
+def compress(input, fmt):
+    """Returns (saved, scale) for input in storage format fmt; scale is None unless fmt is 'int8'"""
+    if fmt is None:
+        return input, None
+    if fmt == 'bf16':
+        return input.to(torch.bfloat16), None
+    if fmt == 'int8':
+        # one scale per sample, so that a single outlier does not flatten the whole batch
+        # reduced with amax rather than through a flattening reshape, which would copy channels_last input
+        absmax = input.detach().abs().amax(tuple(range(1, input.dim())))
+        scale = (absmax / 127.).clamp_(min=1e-12).reshape((-1,) + (1,) * (input.dim() - 1))
+        saved = input.div(scale).round_().clamp_(-127, 127).to(torch.int8)
+        return saved, scale
+    raise ValueError('saved input format %s is not supported' % fmt)
+
+
+def decompress(saved, scale, dtype):
+    """Inverse of compress(); returns the (approximate) input in dtype"""
+    input = saved.to(dtype)
+    if scale is not None:
+        input.mul_(scale)
+    return input
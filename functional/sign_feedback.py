@@ -0,0 +1,31 @@
+"""
+Factored-scale feedback for sign_symmetry
+    - with sign_symmetry, the feedback weight is exactly sign(weight) * scale, so the input gradient is
+        scale * (input gradient with feedback weight sign(weight)); SignFeedback keeps only the ternary sign tensor,
+        in a low precision storage format, and the scalar scale, which is applied after the gradient is computed
+    - None: the feedback weight is passed to the Functions as a regular tensor
+    - 'int8': the sign is saved as torch.int8 (1 byte per weight); the gradient is computed in the dtype of
+        grad_output, so the result only differs from the regular path by rounding
+    - 'bf16': the sign is saved as torch.bfloat16 and the gradient is computed in bfloat16 (grad_output is rounded
+        to bfloat16), then cast back to the dtype of grad_output
+"""
+
+import torch
+
+
+SIGN_FEEDBACK_FORMATS = (None, 'int8', 'bf16')
+
+
+class SignFeedback(object):
+    """The feedback weight sign(weight) * scale, with the sign stored in format fmt"""
+
+    def __init__(self, weight, scale, fmt):
+        assert fmt in SIGN_FEEDBACK_FORMATS[1:], 'sign feedback format %s is not supported' % fmt
+        self.sign = weight.detach().sign().to(torch.int8 if fmt == 'int8' else torch.bfloat16)
+        self.scale = scale
+        self.format = fmt
+
+
+def compute_dtype(fmt, dtype):
+    """Returns the dtype in which the input gradient is computed for sign feedback format fmt and grad_output dtype"""
+    return torch.bfloat16 if fmt == 'bf16' else dtype
@@ -0,0 +1,87 @@
+"""
+Pool of reusable buffers for the tensors that asymmetric feedback layers build in every forward pass
+    - with sign_symmetry (and sign_symmetry_random_magnitude), the feedback weight sign(weight) * scale is a new
+        tensor of the size of the weight at every step; with a pool, the layer computes it in place into the buffer
+        it used at the previous step instead
+    - buffers are keyed by (owner key, name, device), so that nn.DataParallel replicas, which share the owner key of
+        the module they copy, each get their own buffer; a buffer is released and reallocated when the shape, dtype,
+        device or memory format requested for its key changes
+    - pooled bytes are bounded by max_bytes: above it, requests are served by fresh allocations (counted as bypassed)
+        and clear() releases all buffers, e.g. under memory pressure; train.py bounds the pool by the size of the
+        weights of the asymmetric feedback layers (per GPU) unless told otherwise, and clears it after every epoch
+    - reusing a buffer is safe as long as the backward pass of a step runs before the next forward pass of the same
+        layer, as in train.py; otherwise autograd detects that a tensor saved for backward was modified in place and
+        raises an error, rather than computing wrong gradients
+"""
+
+import itertools
+import threading
+
+import torch
+
+
+_owner_keys = itertools.count()
+
+
+def new_owner_key():
+    """Returns a key unique to the calling module, for WorkspacePool.get()"""
+    return next(_owner_keys)
+
+
+def _memory_format(tensor):
+    if tensor.dim() == 4 and not tensor.is_contiguous() and tensor.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+class WorkspacePool(object):
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.bypassed = 0
+        self.bytes_reused = 0
+
+    def get(self, owner_key, name, like):
+        """Returns a buffer with the shape, dtype, device and memory format of tensor like, whose content is
+        undefined; the same buffer is returned for the same (owner_key, name, device) while like does not change"""
+        key = (owner_key, name, like.device)
+        memory_format = _memory_format(like)
+        nbytes = like.numel() * like.element_size()
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is not None and buffer.shape == like.shape and buffer.dtype == like.dtype and \
+                    _memory_format(buffer) == memory_format:
+                self.hits += 1
+                self.bytes_reused += nbytes
+                return buffer
+            # released if the request changed
+            self.buffers.pop(key, None)
+            buffer = torch.empty_like(like, memory_format=memory_format)
+            if self.max_bytes is not None and self.bytes_held() + nbytes > self.max_bytes:
+                self.bypassed += 1
+            else:
+                self.misses += 1
+                self.buffers[key] = buffer
+            return buffer
+
+    def bytes_held(self):
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def clear(self):
+        """Releases all buffers"""
+        with self.lock:
+            self.buffers.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses + self.bypassed
+        return {
+            'requests': requests,
+            'hit_rate': self.hits / requests if requests else 0.,
+            'bytes_reused': self.bytes_reused,
+            'bytes_held': self.bytes_held(),
+            'bypassed': self.bypassed,
+        }
@@ -1,2 +1,8 @@
 from .af_alexnet import *
 from .af_resnet import *
+from .checkpoint import *
+from .convert import *
+from .deferred import *
+from .fuse import *
+from .pipeline import *
+from .sparse import *
@@ -10,6 +10,9 @@ Modified from orchvision/models/alexnet.py
         - removed bias before every batchnorm
         - removed Dropout
     - disabled loading pretrained model
+    - added reset_parameters() for materializing models built on the meta device (see deferred.py)
+    - added adaptive average pooling of the features to 6x6 (as in newer torchvision), so that inputs of other
+        resolutions than 224x224 (e.g. with progressive resizing in train.py) can be used
 """
 
 import torch.nn as nn
@@ -54,6 +57,7 @@ class AlexNet(nn.Module):
             nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=3, stride=2),
         )
+        self.avgpool = nn.AdaptiveAvgPool2d((6, 6))
         if last_layer_af_algo is None or last_layer_af_algo == 'None':
             last_layer = nn.Linear(4096, num_classes)
         else:
@@ -70,9 +74,19 @@ class AlexNet(nn.Module):
             last_layer,
         )
 
+    def reset_parameters(self):
+        """Initializes every parameter & buffer exactly once; used to materialize a model built on the meta device"""
+        for m in self.modules():
+            if isinstance(m, (nn.Conv2d, nn.Linear, nn.BatchNorm1d, nn.BatchNorm2d)):
+                m.reset_parameters()
+            if isinstance(m, (AFConv2d, AFLinear)):
+                m.reset_feedback_weight()
+
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), 256 * 6 * 6)
+        x = self.avgpool(x)
+        # reshape, not view: features may be channels_last
+        x = x.reshape(x.size(0), 256 * 6 * 6)
         x = self.classifier(x)
         return x
 
@@ -6,6 +6,9 @@ Modified from orchvision/models/resnet.py
     - reseting of conv layer weight is appended to also reset feedback weight, so that feedback_alignment_signed_init
         will work correctly
     - disabled loading pretrained model
+    - added reset_parameters() for materializing models built on the meta device (see deferred.py)
+    - added option 'stem' to select between the CIFAR stem (3x3 stride-1 conv1, no max pooling; default) and the
+        original ImageNet stem; average pooling is adaptive
 """
 
 import torch.nn as nn
@@ -16,7 +19,7 @@ from modules.af_linear_module import AsymmetricFeedbackLinear as AFLinear
 
 
 __all__ = ['AsymmetricFeedbackResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
-           'resnet152']
+           'resnet152', 'resolve_stem']
 
 
 # model_urls = {
@@ -28,6 +31,14 @@ __all__ = ['AsymmetricFeedbackResNet', 'resnet18', 'resnet34', 'resnet50', 'resn
 # }
 
 
+def resolve_stem(stem, data):
+    """Returns the stem for a --stem option of 'auto', 'cifar' or 'imagenet' and a data path; auto selects the stem
+    matching the input size: 32px for CIFAR, 224px otherwise"""
+    if stem != 'auto':
+        return stem
+    return 'cifar' if data == 'CIFAR' else 'imagenet'
+
+
 def conv3x3(in_planes, out_planes, af_algo, stride=1):
     """3x3 convolution with padding"""
     return AFConv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -107,11 +118,20 @@ class Bottleneck(nn.Module):
 
 class AsymmetricFeedbackResNet(nn.Module):
 
-    def __init__(self, block, layers, af_algo, num_classes=1000, last_layer_af_algo=None):
+    def __init__(self, block, layers, af_algo, num_classes=1000, last_layer_af_algo=None, stem='cifar'):
+        """
+        Args:
+            stem (str): 'cifar' for 32px inputs (3x3 stride-1 conv1, no max pooling) or 'imagenet' for 224px inputs
+                (7x7 stride-2 conv1 followed by max pooling, as in torchvision)
+        """
+        assert stem in ('cifar', 'imagenet'), 'stem %s is not supported' % stem
         self.inplanes = 64
         super(AsymmetricFeedbackResNet, self).__init__()
-        # self.conv1 = AFConv2d(3, 64, kernel_size=7, stride=2, padding=3,bias=False, algo=af_algo)
-        self.conv1 = AFConv2d(3, 64, kernel_size=3, stride=1, padding=1,bias=False, algo=af_algo)
+        self.stem = stem
+        if stem == 'imagenet':
+            self.conv1 = AFConv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False, algo=af_algo)
+        else:
+            self.conv1 = AFConv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False, algo=af_algo)
         self.bn1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
@@ -119,13 +139,17 @@ class AsymmetricFeedbackResNet(nn.Module):
         self.layer2 = self._make_layer(block, 128, layers[1], stride=2, af_algo=af_algo)
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2, af_algo=af_algo)
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2, af_algo=af_algo)
-        # self.avgpool = nn.AvgPool2d(7, stride=1)
-        self.avgpool = nn.AvgPool2d(4, stride=1)
+        # same as AvgPool2d(7) for 224px inputs with the imagenet stem and AvgPool2d(4) for 32px inputs with the cifar
+        # stem, but also fits other input sizes
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         if last_layer_af_algo is None or last_layer_af_algo == 'None':
             self.fc = nn.Linear(512 * block.expansion, num_classes)
         else:
             self.fc = AFLinear(512 * block.expansion, num_classes, algo=last_layer_af_algo)
 
+        self._init_conv_bn()
+
+    def _init_conv_bn(self):
         for m in self.modules():
             if isinstance(m, AFConv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -135,6 +159,17 @@ class AsymmetricFeedbackResNet(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
+    def reset_parameters(self):
+        """Initializes every parameter & buffer exactly once; used to materialize a model built on the meta device"""
+        for m in self.modules():
+            if isinstance(m, nn.Linear):
+                m.reset_parameters()
+                if isinstance(m, AFLinear):
+                    m.reset_feedback_weight()
+            elif isinstance(m, nn.BatchNorm2d):
+                m.reset_running_stats()
+        self._init_conv_bn()
+
     def _make_layer(self, block, planes, blocks, af_algo, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
@@ -156,7 +191,8 @@ class AsymmetricFeedbackResNet(nn.Module):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
-        # x = self.maxpool(x)
+        if self.stem == 'imagenet':
+            x = self.maxpool(x)
 
         x = self.layer1(x)
         x = self.layer2(x)
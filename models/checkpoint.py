@@ -0,0 +1,26 @@
+"""
+Loading of checkpoints saved by train.py into bare (not DataParallel-wrapped) models
+    - train.py wraps ResNets in nn.DataParallel and AlexNet.features in nn.DataParallel, so the saved state_dict
+        keys contain 'module.' that a bare model does not expect
+"""
+
+import torch
+
+
+__all__ = ['load_checkpoint']
+
+
+def load_checkpoint(model, checkpoint, map_location='cpu'):
+    """Loads the state_dict of a train.py checkpoint (its path, or the dict already loaded from it) into model and
+    returns the whole checkpoint dict"""
+    if not isinstance(checkpoint, dict):
+        checkpoint = torch.load(checkpoint, map_location=map_location)
+    state_dict = checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
+    model.load_state_dict(strip_parallel_prefix(state_dict))
+    return checkpoint
+
+
+def strip_parallel_prefix(state_dict):
+    """Returns state_dict with the 'module' path components added by nn.DataParallel / DistributedDataParallel
+    removed from keys; other names containing 'module', e.g. submodule, are left unchanged"""
+    return {'.'.join(part for part in key.split('.') if part != 'module'): value for key, value in state_dict.items()}
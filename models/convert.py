@@ -0,0 +1,71 @@
+"""
+Conversion of arbitrary feedforward models (e.g. torchvision MobileNet, ShuffleNet) to asymmetric feedback
+    - every nn.Conv2d / nn.Linear is replaced in place by AsymmetricFeedbackConv2d / AsymmetricFeedbackLinear with
+        the same hyperparameters and a copy of its weight & bias; feedback weights are then initialized from the
+        copied weight, so that feedback_alignment_signed_init works correctly
+    - the last conv/linear layer (in module registration order, or given by name) follows a separate policy, as
+        with last_layer_af_algo in af_resnet.py and af_alexnet.py: it is kept as is if last_layer_algo is None
+"""
+
+import torch.nn as nn
+from modules.af_conv2d_module import AsymmetricFeedbackConv2d as AFConv2d
+from modules.af_linear_module import AsymmetricFeedbackLinear as AFLinear
+
+
+__all__ = ['convert_to_asymmetric', 'last_layer']
+
+
+def last_layer(model):
+    """Returns the qualified name and module of the last nn.Conv2d / nn.Linear (asymmetric feedback or not)"""
+    name = layer = None
+    for name_, module in model.named_modules():
+        if isinstance(module, (nn.Conv2d, nn.Linear)):
+            name, layer = name_, module
+    if layer is None:
+        raise ValueError('%s has no conv or linear layer' % model.__class__.__name__)
+    return name, layer
+
+
+def _asymmetric_layer(layer, algo):
+    if isinstance(layer, nn.Conv2d):
+        if layer.padding_mode != 'zeros' or isinstance(layer.padding, str):
+            raise ValueError('only zero padding with explicit sizes is supported in %s' % AFConv2d.__name__)
+        af_layer = AFConv2d(layer.in_channels, layer.out_channels, layer.kernel_size,
+                            stride=layer.stride, padding=layer.padding, dilation=layer.dilation,
+                            groups=layer.groups, bias=layer.bias is not None, algo=algo)
+    else:
+        af_layer = AFLinear(layer.in_features, layer.out_features, bias=layer.bias is not None, algo=algo)
+    af_layer.to(layer.weight.device, layer.weight.dtype)
+    af_layer.weight.data.copy_(layer.weight.data)
+    if layer.bias is not None:
+        af_layer.bias.data.copy_(layer.bias.data)
+    af_layer.weight.requires_grad_(layer.weight.requires_grad)
+    af_layer.reset_feedback_weight()
+    return af_layer
+
+
+def convert_to_asymmetric(model, algo, last_layer_algo=None, last_layer_name=None):
+    """Replaces in place all nn.Conv2d / nn.Linear layers of model by their asymmetric feedback equivalents
+
+    Args:
+        model (nn.Module): model to convert; layers that already use asymmetric feedback are left unchanged
+        algo (str): asymmetric feedback algorithm for all but the last layer
+        last_layer_algo (str): algorithm for the last layer; None or 'None' keeps the last layer unmodified
+        last_layer_name (str): qualified name of the last layer (default: the last conv/linear layer registered)
+    Returns:
+        model
+    """
+    if last_layer_algo == 'None':
+        last_layer_algo = None
+    if last_layer_name is None:
+        last_layer_name = last_layer(model)[0]
+
+    for parent_name, parent in list(model.named_modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) not in (nn.Conv2d, nn.Linear):
+                continue
+            qualified_name = parent_name + '.' + name if parent_name else name
+            layer_algo = last_layer_algo if qualified_name == last_layer_name else algo
+            if layer_algo is not None:
+                setattr(parent, name, _asymmetric_layer(child, layer_algo))
+    return model
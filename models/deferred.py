@@ -0,0 +1,50 @@
+"""
+Deferred construction of models on the meta device, for fast startup
+    - the model is first built on the meta device, where the weight initialization done in the constructors
+        (default layer init, model init, feedback weight init) allocates and computes nothing
+    - its parameters & buffers, including feedback weights, are then created once directly on the target device,
+        either initialized by the model's reset_parameters() or taken directly from a checkpoint state_dict
+Values are determined by the RNG state as usual (same seed & device -> same model), but they differ from those of a
+model built eagerly, since the discarded initializations of eager construction consume random numbers
+"""
+
+import torch
+from modules.af_conv2d_module import AsymmetricFeedbackConv2d as AFConv2d
+from modules.af_linear_module import AsymmetricFeedbackLinear as AFLinear
+from .checkpoint import strip_parallel_prefix
+
+
+__all__ = ['build_on_meta', 'materialize']
+
+
+def build_on_meta(factory, *args, **kwargs):
+    """Returns factory(*args, **kwargs) built on the meta device"""
+    with torch.device('meta'):
+        return factory(*args, **kwargs)
+
+
+def materialize(model, device='cpu', state_dict=None):
+    """Materializes a model built by build_on_meta() in place on device and returns it
+
+    Args:
+        model (nn.Module): model on the meta device
+        device (str or torch.device): device to create parameters & buffers on
+        state_dict (dict): if given (e.g. checkpoint['state_dict'] from train.py), parameters & buffers are taken from
+            it instead of being initialized; 'module.' prefixes of nn.DataParallel are removed
+    """
+    if state_dict is not None:
+        model.load_state_dict(strip_parallel_prefix(state_dict), assign=True)
+        return model.to(device)
+
+    model.to_empty(device=device)
+    with torch.no_grad():
+        if hasattr(model, 'reset_parameters'):
+            model.reset_parameters()
+        else:
+            # e.g. models converted by convert_to_asymmetric(): default initialization of every layer
+            for m in model.modules():
+                if hasattr(m, 'reset_parameters'):
+                    m.reset_parameters()
+                if isinstance(m, (AFConv2d, AFLinear)):
+                    m.reset_feedback_weight()
+    return model
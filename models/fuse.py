@@ -0,0 +1,100 @@
+"""
+Conversion of trained asymmetric feedback models into plain feedforward models for inference
+    - AsymmetricFeedbackConv2d / AsymmetricFeedbackLinear are replaced by nn.Conv2d / nn.Linear,
+        which drops the feedback weight buffers that are only used in the backward pass
+    - a BatchNorm layer registered right after a conv/linear layer in the same parent module is folded into the
+        weight & bias of that layer and replaced by nn.Identity; this holds for all models in this package, where
+        every BatchNorm directly consumes the output of the preceding conv/linear layer
+    - nn.DataParallel wrappers (e.g. around AlexNet.features in train.py) are unwrapped
+"""
+
+import copy
+import torch
+import torch.nn as nn
+
+
+__all__ = ['fuse_for_inference']
+
+
+def _plain_layer(layer):
+    """Returns a nn.Conv2d / nn.Linear copy of a (possibly asymmetric feedback) conv/linear layer"""
+    # AsymmetricFeedbackConv2d / AsymmetricFeedbackLinear subclass nn.Conv2d / nn.Linear
+    if isinstance(layer, nn.Conv2d):
+        plain = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size,
+                          stride=layer.stride, padding=layer.padding, dilation=layer.dilation,
+                          groups=layer.groups, bias=layer.bias is not None, padding_mode=layer.padding_mode)
+    else:
+        plain = nn.Linear(layer.in_features, layer.out_features, bias=layer.bias is not None)
+    plain.to(layer.weight.device, layer.weight.dtype)
+    plain.weight.data.copy_(layer.weight.data)
+    if layer.bias is not None:
+        plain.bias.data.copy_(layer.bias.data)
+    return plain
+
+
+def _fold_bn(layer, bn):
+    """Folds eval-mode BatchNorm bn into the plain conv/linear layer in place; adds a bias if needed"""
+    if not bn.track_running_stats:
+        raise ValueError('cannot fold %s without running statistics' % bn.__class__.__name__)
+    inv_std = torch.rsqrt(bn.running_var + bn.eps)
+    scale = inv_std if bn.weight is None else bn.weight.data * inv_std
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias.data
+    if layer.bias is None:
+        layer.bias = nn.Parameter(torch.zeros_like(shift))
+    else:
+        shift = shift + layer.bias.data * scale
+    layer.weight.data.mul_(scale.reshape((-1,) + (1,) * (layer.weight.dim() - 1)))
+    layer.bias.data.copy_(shift)
+
+
+def _fuse_children(module):
+    names = []
+    for name, child in list(module.named_children()):
+        if isinstance(child, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            child = child.module
+            setattr(module, name, child)
+        if isinstance(child, (nn.Conv2d, nn.Linear)):
+            # plain nn.Conv2d / nn.Linear are also copied so that a BatchNorm can be folded in
+            child = _plain_layer(child)
+            setattr(module, name, child)
+        elif isinstance(child, (nn.BatchNorm1d, nn.BatchNorm2d)) and names:
+            prev = getattr(module, names[-1])
+            if isinstance(prev, (nn.Conv2d, nn.Linear)) and prev.weight.size(0) == child.num_features:
+                _fold_bn(prev, child)
+                child = nn.Identity()
+                setattr(module, name, child)
+        else:
+            _fuse_children(child)
+        names.append(name)
+
+
+def fuse_for_inference(model, example_input=None, rtol=1e-3, atol=1e-4):
+    """Returns an eval-mode copy of model with BatchNorm folded and all asymmetric feedback layers replaced by
+    nn.Conv2d / nn.Linear; the original model is left unchanged
+
+    Args:
+        model (nn.Module): trained model, e.g. AsymmetricFeedbackResNet or AlexNet (optionally DataParallel)
+        example_input (Tensor): if given, the outputs of the fused model and of model in eval mode are compared on it
+            and a RuntimeError is raised if they do not match to within rtol & atol
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module
+    was_training = model.training
+    fused = copy.deepcopy(model).eval()
+    if isinstance(fused, (nn.Conv2d, nn.Linear)):
+        fused = _plain_layer(fused).eval()
+    else:
+        _fuse_children(fused)
+
+    if example_input is not None:
+        model.eval()
+        with torch.no_grad():
+            expected = model(example_input)
+            actual = fused(example_input)
+        model.train(was_training)
+        if not torch.allclose(actual, expected, rtol=rtol, atol=atol):
+            raise RuntimeError('fused model does not match the original model in eval mode '
+                               '(max abs difference %.3e)' % (actual - expected).abs().max().item())
+    return fused
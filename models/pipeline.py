@@ -0,0 +1,221 @@
+"""
+Pipeline-parallel execution of asymmetric feedback ResNets across processes
+    - partition_resnet() splits a model into consecutive stages: the stem goes to the first stage, the residual
+        blocks of layer1..layer4 are divided evenly (or as given by balance) between the stages, and the pooling & fc
+        head go to the last stage
+    - each process runs one PipelineStage; stages exchange activations, gradients and targets point to point with
+        torch.distributed (e.g. the gloo backend for CPU processes on one or several machines); sends are
+        asynchronous and receives blocking, which makes both schedules deadlock-free
+    - a batch is split into micro-batches, scheduled GPipe-style ('gpipe': all forwards, then all backwards) or
+        '1f1b' (after a warmup, each stage alternates forwards & backwards, holding the activations of at most
+        num_stages micro-batches)
+    - backward passes are regular autograd calls through the stage, so the asymmetric feedback Functions work
+        unchanged; micro-batch losses are weighted by micro-batch size, so that gradients accumulated over a batch
+        are those of the full batch (except for BatchNorm statistics, computed per micro-batch) and each stage can
+        step its own optimizer (e.g. BMNSC_SGD) on its parameters
+    - stage_state_dict() keys are those of the full model, so that the stages' state dicts can be merged into a
+        checkpoint for the unpartitioned model
+"""
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+__all__ = ['partition_resnet', 'stage_named_parameters', 'stage_state_dict', 'PipelineStage']
+
+
+ACTIVATION_TAG, GRADIENT_TAG, TARGET_TAG = 0, 1, 2
+_DTYPES = (torch.float32, torch.float16, torch.bfloat16, torch.float64, torch.int64)
+_MAX_DIMS = 8
+
+
+class _Stage(nn.Sequential):
+    """Consecutive modules of a model, with their qualified names in the model (None for added modules)"""
+
+    def __init__(self, named_modules):
+        super(_Stage, self).__init__(*[module for name, module in named_modules])
+        self.qualified_names = [name for name, module in named_modules]
+
+
+def partition_resnet(model, num_stages, balance=None):
+    """Returns the list of num_stages stages (nn.Modules) of AsymmetricFeedbackResNet model
+
+    Args:
+        balance (list of int): number of residual blocks of each stage (default: as even as possible)
+    """
+    blocks = [('%s.%d' % (layer_name, i), block)
+              for layer_name in ('layer1', 'layer2', 'layer3', 'layer4')
+              for i, block in enumerate(getattr(model, layer_name))]
+    if balance is None:
+        balance = [len(blocks) // num_stages + (stage < len(blocks) % num_stages) for stage in range(num_stages)]
+    if len(balance) != num_stages or sum(balance) != len(blocks) or min(balance) < 0:
+        raise ValueError('balance %s does not split %d blocks into %d stages' % (balance, len(blocks), num_stages))
+
+    stem = [('conv1', model.conv1), ('bn1', model.bn1), ('relu', model.relu)]
+    if model.stem == 'imagenet':
+        stem.append(('maxpool', model.maxpool))
+    head = [('avgpool', model.avgpool), (None, nn.Flatten()), ('fc', model.fc)]
+
+    stages = []
+    start = 0
+    for stage, size in enumerate(balance):
+        named_modules = blocks[start:start + size]
+        start += size
+        if stage == 0:
+            named_modules = stem + named_modules
+        if stage == num_stages - 1:
+            named_modules = named_modules + head
+        stages.append(_Stage(named_modules))
+    return stages
+
+
+def stage_named_parameters(stage):
+    """Returns the list of (name, parameter) of a stage built by partition_resnet(), with the names of the full model"""
+    return [(name + '.' + key, parameter)
+            for module, name in zip(stage.children(), stage.qualified_names) if name is not None
+            for key, parameter in module.named_parameters()]
+
+
+def stage_state_dict(stage):
+    """Returns the state dict of a stage built by partition_resnet(), with the keys of the full model"""
+    return {name + '.' + key: value
+            for module, name in zip(stage.children(), stage.qualified_names) if name is not None
+            for key, value in module.state_dict().items()}
+
+
+class PipelineStage(object):
+    """Runs stage stage (of num_stages) of a pipeline in this process
+
+    Args:
+        module (nn.Module): the stage, e.g. from partition_resnet()
+        ranks (list of int): the rank of the process running each stage (default: rank i runs stage i)
+        device (str or torch.device): device of the stage; tensors are communicated on the CPU unless the backend is
+            nccl
+    """
+
+    def __init__(self, module, stage, num_stages, ranks=None, device='cpu'):
+        self.module = module
+        self.stage = stage
+        self.num_stages = num_stages
+        self.ranks = list(range(num_stages)) if ranks is None else ranks
+        self.device = torch.device(device)
+        self.comm_device = self.device if dist.get_backend() == 'nccl' else torch.device('cpu')
+        self._pending = []
+
+    @property
+    def is_first(self):
+        return self.stage == 0
+
+    @property
+    def is_last(self):
+        return self.stage == self.num_stages - 1
+
+    def _send(self, tensor, stage, tag):
+        tensor = tensor.detach().to(self.comm_device).contiguous()
+        header = torch.zeros(2 + _MAX_DIMS, dtype=torch.int64, device=self.comm_device)
+        header[0] = tensor.dim()
+        header[1] = _DTYPES.index(tensor.dtype)
+        header[2:2 + tensor.dim()] = torch.tensor(tensor.shape, dtype=torch.int64)
+        # kept alive until the sends complete in _wait_sends()
+        for t in (header, tensor):
+            self._pending.append((dist.isend(t, self.ranks[stage], tag=tag), t))
+
+    def _recv(self, stage, tag):
+        header = torch.empty(2 + _MAX_DIMS, dtype=torch.int64, device=self.comm_device)
+        dist.recv(header, self.ranks[stage], tag=tag)
+        header = header.tolist()
+        tensor = torch.empty(header[2:2 + header[0]], dtype=_DTYPES[header[1]], device=self.comm_device)
+        dist.recv(tensor, self.ranks[stage], tag=tag)
+        return tensor.to(self.device)
+
+    def _wait_sends(self):
+        for work, tensor in self._pending:
+            work.wait()
+        self._pending = []
+
+    def _targets(self, target, num_microbatches):
+        # the first stage holds the targets of the batch and sends them to the last stage
+        if self.is_first and not self.is_last:
+            self._send(target, self.num_stages - 1, TARGET_TAG)
+        elif self.is_last and not self.is_first:
+            target = self._recv(0, TARGET_TAG)
+        if self.is_last:
+            return target, target.tensor_split(num_microbatches)
+        return None, None
+
+    def train_step(self, input=None, target=None, criterion=None, num_microbatches=1, schedule='1f1b'):
+        """Runs the forward & backward passes of this stage for a batch, accumulating parameter gradients
+
+        Args:
+            input, target (Tensor): the batch, only used on the first stage
+            criterion: loss function (with mean reduction), only used on the last stage
+            num_microbatches (int): number of micro-batches the batch is split into; at most the batch size
+            schedule (str): 'gpipe' or '1f1b'
+        Returns:
+            (loss, output, target) of the batch on the last stage, (None, None, None) on the other stages
+        """
+        assert schedule in ('gpipe', '1f1b'), 'schedule %s is not supported' % schedule
+        target, targets = self._targets(target, num_microbatches)
+        inputs = input.tensor_split(num_microbatches) if self.is_first else None
+        saved = {}
+        outputs = []
+        losses = []
+
+        def forward(m):
+            if self.is_first:
+                x = inputs[m]
+            else:
+                x = self._recv(self.stage - 1, ACTIVATION_TAG).requires_grad_()
+            y = self.module(x)
+            if self.is_last:
+                outputs.append(y.detach())
+                # weighted by micro-batch size: gradients are accumulated into those of the batch mean loss
+                y = criterion(y, targets[m]) * (len(targets[m]) / len(target))
+                losses.append(y.detach())
+            else:
+                self._send(y, self.stage + 1, ACTIVATION_TAG)
+            saved[m] = (x, y)
+
+        def backward(m):
+            x, y = saved.pop(m)
+            if self.is_last:
+                y.backward()
+            else:
+                y.backward(self._recv(self.stage + 1, GRADIENT_TAG))
+            if not self.is_first:
+                self._send(x.grad, self.stage - 1, GRADIENT_TAG)
+
+        if schedule == 'gpipe':
+            warmup = num_microbatches
+        else:
+            warmup = min(self.num_stages - self.stage - 1, num_microbatches)
+        for m in range(warmup):
+            forward(m)
+        for m in range(warmup, num_microbatches):
+            forward(m)
+            backward(m - warmup)
+        for m in range(num_microbatches - warmup, num_microbatches):
+            backward(m)
+        self._wait_sends()
+
+        if self.is_last:
+            return torch.stack(losses).sum(), torch.cat(outputs), target
+        return None, None, None
+
+    def forward_step(self, input=None, target=None):
+        """Runs the forward pass of this stage for a batch without gradients, e.g. for evaluation
+
+        Returns:
+            (output, target) on the last stage, (None, None) on the other stages
+        """
+        target, _ = self._targets(target, 1)
+        with torch.no_grad():
+            x = input if self.is_first else self._recv(self.stage - 1, ACTIVATION_TAG)
+            y = self.module(x)
+            if not self.is_last:
+                self._send(y, self.stage + 1, ACTIVATION_TAG)
+        self._wait_sends()
+        if self.is_last:
+            return y, target
+        return None, None
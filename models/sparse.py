@@ -0,0 +1,218 @@
+"""
+Sparse inference from the weights pinned by No-sign-change
+    - BMNSC_SGD with no_sign_change sets the weights whose update would change their sign to +/- lower_bound (1e-10),
+        which are effectively zero; pinned_weights_report() counts them per conv/linear layer, with the output and
+        input channels whose weights are all pinned
+    - prune_pinned_weights() sets them to exact zeros in place; pruning is done before fuse_for_inference(), which
+        scales the weights of a layer by the BatchNorm folded into it, so that pinned weights would no longer be at
+        +/- lower_bound, while zeros remain zeros
+    - sparsify_for_inference() replaces the conv/linear layers of a fused model with
+        - CompactConv2d / CompactLinear (structured sparsity): dense kernels restricted to the input & output channels
+            that are not all zero; the outputs of the dropped channels are their bias
+        - SparseConv2d / SparseLinear (unstructured sparsity): the weight in CSR format, multiplied with the input
+            (unfolded, for convolutions); on the CPU, this only pays off at high sparsity (above ~90%)
+        for each layer, the variants are timed on the input of the layer for an example batch, and the fastest one is
+        kept if it is faster than the dense layer by min_speedup
+"""
+
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+__all__ = ['pinned_weights_report', 'prune_pinned_weights', 'sparsify_for_inference',
+           'CompactConv2d', 'CompactLinear', 'SparseConv2d', 'SparseLinear']
+
+
+def _layers(model):
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, (nn.Conv2d, nn.Linear))]
+
+
+def pinned_weights_report(model, lower_bound=1e-10):
+    """Returns a list of dicts, one per conv/linear layer of model (asymmetric feedback or not): name, weights,
+    pinned (weights at +/- lower_bound or 0), sparsity (fraction pinned), pinned_out_channels and
+    pinned_in_channels (channels whose weights are all pinned)"""
+    report = []
+    for name, layer in _layers(model):
+        # compared in the dtype of the weight, in which pinned weights are exactly +/- lower_bound
+        pinned = layer.weight.detach().abs() <= lower_bound
+        per_out = pinned.flatten(1).all(1)
+        per_in = pinned.transpose(0, 1).flatten(1).all(1)
+        report.append({
+            'name': name,
+            'weights': pinned.numel(),
+            'pinned': int(pinned.sum()),
+            'sparsity': pinned.float().mean().item(),
+            'pinned_out_channels': int(per_out.sum()),
+            'pinned_in_channels': int(per_in.sum()),
+        })
+    return report
+
+
+def prune_pinned_weights(model, lower_bound=1e-10):
+    """Sets the weights at +/- lower_bound of the conv/linear layers of model to 0, in place; returns their number"""
+    pruned = 0
+    with torch.no_grad():
+        for name, layer in _layers(model):
+            pinned = layer.weight.abs() <= lower_bound
+            pruned += int(pinned.sum())
+            layer.weight.masked_fill_(pinned, 0.)
+    return pruned
+
+
+def _nonzero_channels(weight):
+    """Returns the indices of the output and input channels of weight that are not all zero"""
+    nonzero = weight != 0
+    return (nonzero.flatten(1).any(1).nonzero().flatten(),
+            nonzero.transpose(0, 1).flatten(1).any(1).nonzero().flatten())
+
+
+class CompactLinear(nn.Module):
+    def __init__(self, linear):
+        super(CompactLinear, self).__init__()
+        self.out_features = linear.out_features
+        out_index, in_index = _nonzero_channels(linear.weight.detach())
+        self.register_buffer('out_index', out_index)
+        self.register_buffer('in_index', in_index)
+        self.register_buffer('weight', linear.weight.detach()[out_index][:, in_index].clone())
+        bias = linear.bias.detach() if linear.bias is not None else linear.weight.new_zeros(self.out_features)
+        self.register_buffer('bias', bias.clone())
+
+    def forward(self, input):
+        output = F.linear(input.index_select(-1, self.in_index), self.weight, self.bias[self.out_index])
+        if len(self.out_index) == self.out_features:
+            return output
+        full = self.bias.expand(input.shape[:-1] + (self.out_features,)).clone()
+        full[..., self.out_index] = output
+        return full
+
+
+class CompactConv2d(nn.Module):
+    def __init__(self, conv):
+        assert conv.groups == 1 and conv.padding_mode == 'zeros', 'only dense zero-padded convolutions are supported'
+        super(CompactConv2d, self).__init__()
+        self.out_channels = conv.out_channels
+        self.stride, self.padding, self.dilation = conv.stride, conv.padding, conv.dilation
+        out_index, in_index = _nonzero_channels(conv.weight.detach())
+        self.register_buffer('out_index', out_index)
+        self.register_buffer('in_index', in_index)
+        self.register_buffer('weight', conv.weight.detach()[out_index][:, in_index].clone())
+        bias = conv.bias.detach() if conv.bias is not None else conv.weight.new_zeros(self.out_channels)
+        self.register_buffer('bias', bias.clone())
+
+    def forward(self, input):
+        output = F.conv2d(input.index_select(1, self.in_index), self.weight, self.bias[self.out_index],
+                          self.stride, self.padding, self.dilation)
+        if len(self.out_index) == self.out_channels:
+            return output
+        full = self.bias.view(1, -1, 1, 1).expand(
+            output.size(0), self.out_channels, output.size(2), output.size(3)).clone()
+        full[:, self.out_index] = output
+        return full
+
+
+class SparseLinear(nn.Module):
+    def __init__(self, linear):
+        super(SparseLinear, self).__init__()
+        self.out_features = linear.out_features
+        self.register_buffer('weight', linear.weight.detach().to_sparse_csr())
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().clone())
+
+    def forward(self, input):
+        input_2d = input.reshape(-1, input.size(-1))
+        output = torch.sparse.mm(self.weight, input_2d.t()).t()
+        if self.bias is not None:
+            output = output + self.bias
+        return output.reshape(input.shape[:-1] + (self.out_features,))
+
+
+class SparseConv2d(nn.Module):
+    def __init__(self, conv):
+        assert conv.groups == 1 and conv.padding_mode == 'zeros', 'only dense zero-padded convolutions are supported'
+        super(SparseConv2d, self).__init__()
+        self.out_channels = conv.out_channels
+        self.kernel_size, self.stride, self.padding, self.dilation = \
+            conv.kernel_size, conv.stride, conv.padding, conv.dilation
+        self.register_buffer('weight', conv.weight.detach().flatten(1).to_sparse_csr())
+        self.register_buffer('bias', None if conv.bias is None else conv.bias.detach().clone())
+
+    def forward(self, input):
+        n, _, h, w = input.shape
+        out_h = (h + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+        out_w = (w + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+        # (N, C * kh * kw, L) -> (C * kh * kw, N * L)
+        columns = F.unfold(input, self.kernel_size, self.dilation, self.padding, self.stride)
+        columns = columns.transpose(0, 1).reshape(columns.size(1), -1)
+        output = torch.sparse.mm(self.weight, columns).view(self.out_channels, n, out_h, out_w).transpose(0, 1)
+        if self.bias is not None:
+            output = output + self.bias.view(1, -1, 1, 1)
+        return output
+
+
+def _time(layer, input, repeats):
+    with torch.no_grad():
+        layer(input)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            layer(input)
+    return (time.perf_counter() - start) / repeats
+
+
+def _variants(layer):
+    """Returns the list of (kind, module) sparse variants of a plain conv/linear layer"""
+    if isinstance(layer, nn.Conv2d) and (layer.groups != 1 or layer.padding_mode != 'zeros'):
+        return []
+    weight = layer.weight.detach()
+    variants = []
+    out_index, in_index = _nonzero_channels(weight)
+    if 0 < len(out_index) and 0 < len(in_index) and \
+            (len(out_index) < weight.size(0) or len(in_index) < weight.size(1)):
+        variants.append(('compact', (CompactConv2d if isinstance(layer, nn.Conv2d) else CompactLinear)(layer)))
+    # CSR kernels are much slower than dense ones at moderate sparsity
+    if (weight == 0).float().mean().item() >= 0.5:
+        variants.append(('sparse', (SparseConv2d if isinstance(layer, nn.Conv2d) else SparseLinear)(layer)))
+    return variants
+
+
+def sparsify_for_inference(model, example_input, min_speedup=1.1, repeats=10, rtol=1e-3, atol=1e-4):
+    """Returns (copy of model with the layers replaced by faster sparse variants, report), for a plain model in eval
+    mode, e.g. from fuse_for_inference() after prune_pinned_weights(); the original model is left unchanged
+
+    The report lists, per conv/linear layer: name, kind ('dense', 'compact' or 'sparse'), dense_time and time (in
+    seconds, on the input of the layer for example_input). A RuntimeError is raised if the outputs of the copy and of
+    model do not match to within rtol & atol on example_input.
+    """
+    sparse_model = copy.deepcopy(model).eval()
+    inputs = {}
+    handles = [layer.register_forward_pre_hook(lambda module, input, name=name: inputs.setdefault(name, input[0]))
+               for name, layer in _layers(sparse_model)]
+    with torch.no_grad():
+        expected = sparse_model(example_input)
+    for handle in handles:
+        handle.remove()
+
+    report = []
+    for name, layer in _layers(sparse_model):
+        if name not in inputs:
+            # not used in the forward pass
+            continue
+        dense_time = _time(layer, inputs[name], repeats)
+        best = ('dense', layer, dense_time)
+        for kind, variant in _variants(layer):
+            variant_time = _time(variant, inputs[name], repeats)
+            if variant_time * min_speedup < dense_time and variant_time < best[2]:
+                best = (kind, variant, variant_time)
+        if best[1] is not layer:
+            parent_name, _, child_name = name.rpartition('.')
+            setattr(sparse_model.get_submodule(parent_name), child_name, best[1])
+        report.append({'name': name, 'kind': best[0], 'dense_time': dense_time, 'time': best[2]})
+
+    with torch.no_grad():
+        actual = sparse_model(example_input)
+    if not torch.allclose(actual, expected, rtol=rtol, atol=atol):
+        raise RuntimeError('sparse model does not match the original model '
+                           '(max abs difference %.3e)' % (actual - expected).abs().max().item())
+    return sparse_model, report
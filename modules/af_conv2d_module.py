@@ -5,6 +5,11 @@ Supports asymmetric feedback algorithms using the autograd Function defined in a
 with a control option
     - sham: uses feedforward weights for feedback as in backprop; should behave just like nn.Conv2d
     - other related algorithms: 'sign_symmetry_random_magnitude', 'feedback_alignment_signed_init'
+dilation and groups (including depthwise convolution) are supported for all algorithms
+with regenerate_feedback=True, feedback_alignment stores only a seed and regenerates the feedback weight in the
+backward pass (see regenerated_feedback.py)
+with sign_feedback_format 'int8' or 'bf16', sign_symmetry passes its feedback weight as a low precision sign and a
+scale that is applied after computing the input gradient (see sign_feedback.py)
 References:
     - https://github.com/L0SG/feedback-alignment-pytorch/blob/master/lib/fa_linear.py
 """
@@ -12,16 +17,27 @@ References:
 import torch
 import torch.nn as nn
 from functional.af_conv2d_function import AsymmetricFeedbackConv2dFunc
+from functional.regenerated_feedback import RegeneratedFeedback
+from functional.saved_input import SAVED_INPUT_FORMATS
+from functional.sign_feedback import SIGN_FEEDBACK_FORMATS, SignFeedback
+from functional.workspace import new_owner_key
 import math
 
 
 class AsymmetricFeedbackConv2d(nn.Conv2d):
-    def __init__(self, *args, algo='sign_symmetry', **kwargs):
+    def __init__(self, *args, algo='sign_symmetry', saved_input_format=None, regenerate_feedback=False,
+                 sign_feedback_format=None, **kwargs):
         assert algo in ('sign_symmetry', 'sign_symmetry_random_magnitude',
                         'feedback_alignment', 'feedback_alignment_signed_init', 'sham'),\
             'algorithm %s is not supported' % algo
-        if 'dilation' in kwargs.keys() and kwargs['dilation'] != 1:
-            raise ValueError('dilation is not supported in this implementation of', self.__class__.__name__)
+        assert saved_input_format in SAVED_INPUT_FORMATS,\
+            'saved input format %s is not supported' % saved_input_format
+        assert not regenerate_feedback or algo == 'feedback_alignment',\
+            'regenerated feedback weights are only supported for feedback_alignment'
+        assert sign_feedback_format in SIGN_FEEDBACK_FORMATS,\
+            'sign feedback format %s is not supported' % sign_feedback_format
+        assert sign_feedback_format is None or algo == 'sign_symmetry',\
+            'sign feedback formats are only supported for sign_symmetry'
         super(AsymmetricFeedbackConv2d, self).__init__(*args, **kwargs)
 
         # this scale is used to initialize resnet models in torchvision/models/resnet.py
@@ -29,28 +45,55 @@ class AsymmetricFeedbackConv2d(nn.Conv2d):
         self.scale = math.sqrt(2 / (self.kernel_size[0] * self.kernel_size[1] * self.out_channels))
 
         self.algo = algo
-        # save tensor version of stride & padding for use in ws_conv2d_function
-        stride_tensor = torch.Tensor(self.stride).type(torch.int)
-        padding_tensor = torch.Tensor(self.padding).type(torch.int)
-        self.register_buffer('stride_tensor', stride_tensor)
-        self.register_buffer('padding_tensor', padding_tensor)
+        # storage format of the input activation saved for computing the weight gradient; see saved_input.py
+        self.saved_input_format = saved_input_format
+        # for feedback_alignment, only store a seed and regenerate the feedback weight in backward;
+        # see regenerated_feedback.py
+        self.regenerate_feedback = regenerate_feedback
+        # for sign_symmetry, pass the feedback weight as a low precision sign and a scale; see sign_feedback.py
+        self.sign_feedback_format = sign_feedback_format
+        # optional WorkspacePool in which the feedback weight is built at every step; see workspace.py
+        self.workspace_pool = None
+        self.workspace_key = new_owner_key()
         self.reset_feedback_weight()
 
     def reset_feedback_weight(self):
-        feedback_weight = None
-        if self.algo in ('feedback_alignment', 'sign_symmetry_random_magnitude'):
+        feedback_weight = feedback_seed = None
+        if self.algo == 'feedback_alignment' and self.regenerate_feedback:
+            # only the seed of the feedback weight is stored
+            feedback_seed = torch.randint(2 ** 62, (), dtype=torch.int64, device=self.weight.device)
+        elif self.algo in ('feedback_alignment', 'sign_symmetry_random_magnitude'):
             feedback_weight = self.weight.new_empty(self.weight.shape).detach_()
             feedback_weight.data.normal_(0, self.scale)
             if self.algo == 'sign_symmetry_random_magnitude':
                 feedback_weight = feedback_weight.abs_()
         if self.algo == 'feedback_alignment_signed_init':
             feedback_weight = self.weight.sign().detach_() * self.scale
+        self.register_buffer('feedback_seed', feedback_seed)
         self.register_buffer('feedback_weight', feedback_weight)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints stored stride & padding as buffers; they are now passed to the Function as tuples
+        for name in ('stride_tensor', 'padding_tensor'):
+            state_dict.pop(prefix + name, None)
+        super(AsymmetricFeedbackConv2d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, input):
-        if self.algo in ('feedback_alignment', 'feedback_alignment_signed_init'):
+        if not (torch.is_grad_enabled() and input.requires_grad):
+            # no input gradient (first layer, evaluation): the feedback weight is not needed
+            feedback_weight = None
+        elif self.regenerate_feedback:
+            feedback_weight = RegeneratedFeedback(self.feedback_seed, self.weight.shape, 'normal', self.scale)
+        elif self.algo in ('feedback_alignment', 'feedback_alignment_signed_init'):
             feedback_weight = self.feedback_weight
         # symmetrical weight for backprop is initialized here
+        elif self.algo == 'sign_symmetry' and self.sign_feedback_format is not None:
+            feedback_weight = SignFeedback(self.weight, self.scale, self.sign_feedback_format)
+        elif self.workspace_pool is not None and self.algo in ('sign_symmetry', 'sign_symmetry_random_magnitude'):
+            # computed in place into the buffer of the previous step
+            feedback_weight = torch.sign(self.weight.detach(), out=self.workspace_pool.get(
+                self.workspace_key, 'feedback_weight', self.weight))
+            feedback_weight.mul_(self.scale if self.algo == 'sign_symmetry' else self.feedback_weight)
         elif self.algo == 'sign_symmetry':
             feedback_weight = self.weight.sign().detach_() * self.scale
         elif self.algo == 'sign_symmetry_random_magnitude':
@@ -61,5 +104,6 @@ class AsymmetricFeedbackConv2d(nn.Conv2d):
             raise RuntimeError('unsupported algorithm for %s' % self.__class__.__name__)
 
         return AsymmetricFeedbackConv2dFunc.apply(
-            input, self.weight, feedback_weight, self.bias, self.stride_tensor, self.padding_tensor)
+            input, self.weight, feedback_weight, self.bias, self.stride, self.padding, self.dilation, self.groups,
+            self.saved_input_format)
 
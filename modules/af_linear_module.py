@@ -3,38 +3,81 @@ Modified from https://github.com/L0SG/feedback-alignment-pytorch/blob/master/lib
 """
 
 import math
+import torch
 import torch.nn as nn
 from functional.af_linear_function import AsymmetricFeedbackLinearFunc
+from functional.regenerated_feedback import RegeneratedFeedback
+from functional.saved_input import SAVED_INPUT_FORMATS
+from functional.sign_feedback import SIGN_FEEDBACK_FORMATS, SignFeedback
+from functional.workspace import new_owner_key
 
 
 class AsymmetricFeedbackLinear(nn.Linear):
 
-    def __init__(self,  *args, algo='sign_symmetry', **kwargs):
+    def __init__(self,  *args, algo='sign_symmetry', saved_input_format=None, regenerate_feedback=False,
+                 sign_feedback_format=None, **kwargs):
         assert algo in ('sign_symmetry', 'sign_symmetry_random_magnitude',
                         'feedback_alignment', 'feedback_alignment_signed_init', 'sham'),\
             'algorithm %s is not supported' % algo
+        assert saved_input_format in SAVED_INPUT_FORMATS,\
+            'saved input format %s is not supported' % saved_input_format
+        assert not regenerate_feedback or algo == 'feedback_alignment',\
+            'regenerated feedback weights are only supported for feedback_alignment'
+        assert sign_feedback_format in SIGN_FEEDBACK_FORMATS,\
+            'sign feedback format %s is not supported' % sign_feedback_format
+        assert sign_feedback_format is None or algo == 'sign_symmetry',\
+            'sign feedback formats are only supported for sign_symmetry'
         super(AsymmetricFeedbackLinear, self).__init__(*args, **kwargs)
 
         # this scale is used to initialize weights in torchvision/nn/modules/linear.py
         self.scale = 1. / math.sqrt(self.weight.size(1))
 
         self.algo = algo
-        feedback_weight = None
-        if algo in ('feedback_alignment', 'sign_symmetry_random_magnitude'):
+        # storage format of the input activation saved for computing the weight gradient; see saved_input.py
+        self.saved_input_format = saved_input_format
+        # for feedback_alignment, only store a seed and regenerate the feedback weight in backward;
+        # see regenerated_feedback.py
+        self.regenerate_feedback = regenerate_feedback
+        # for sign_symmetry, pass the feedback weight as a low precision sign and a scale; see sign_feedback.py
+        self.sign_feedback_format = sign_feedback_format
+        # optional WorkspacePool in which the feedback weight is built at every step; see workspace.py
+        self.workspace_pool = None
+        self.workspace_key = new_owner_key()
+        self.reset_feedback_weight()
+
+    def reset_feedback_weight(self):
+        feedback_weight = feedback_seed = None
+        if self.algo == 'feedback_alignment' and self.regenerate_feedback:
+            # only the seed of the feedback weight is stored
+            feedback_seed = torch.randint(2 ** 62, (), dtype=torch.int64, device=self.weight.device)
+        elif self.algo in ('feedback_alignment', 'sign_symmetry_random_magnitude'):
             feedback_weight = self.weight.new_empty(self.weight.shape).detach_()
-            if algo == 'sign_symmetry_random_magnitude':
+            if self.algo == 'sign_symmetry_random_magnitude':
                 feedback_weight.data.uniform_(0, self.scale)
             else:
                 # this init formula is used in Linear.reset_parameters() in torchvision/nn/modules/linear.py
                 feedback_weight.data.uniform_(-self.scale, self.scale)  # * math.sqrt(3) for equal stdev to other algos
-        if algo == 'feedback_alignment_signed_init':
+        if self.algo == 'feedback_alignment_signed_init':
             feedback_weight = self.weight.sign().detach_() * self.scale
+        self.register_buffer('feedback_seed', feedback_seed)
         self.register_buffer('feedback_weight', feedback_weight)
 
     def forward(self, input):
-        if self.algo == 'feedback_alignment' or self.algo == 'feedback_alignment_signed_init':
+        if not (torch.is_grad_enabled() and input.requires_grad):
+            # no input gradient (first layer, evaluation): the feedback weight is not needed
+            feedback_weight = None
+        elif self.regenerate_feedback:
+            feedback_weight = RegeneratedFeedback(self.feedback_seed, self.weight.shape, 'uniform', self.scale)
+        elif self.algo == 'feedback_alignment' or self.algo == 'feedback_alignment_signed_init':
             feedback_weight = self.feedback_weight
         # symmetrical weight for backprop is initialized here
+        elif self.algo == 'sign_symmetry' and self.sign_feedback_format is not None:
+            feedback_weight = SignFeedback(self.weight, self.scale, self.sign_feedback_format)
+        elif self.workspace_pool is not None and self.algo in ('sign_symmetry', 'sign_symmetry_random_magnitude'):
+            # computed in place into the buffer of the previous step
+            feedback_weight = torch.sign(self.weight.detach(), out=self.workspace_pool.get(
+                self.workspace_key, 'feedback_weight', self.weight))
+            feedback_weight.mul_(self.scale if self.algo == 'sign_symmetry' else self.feedback_weight)
         elif self.algo == 'sign_symmetry':
             feedback_weight = self.weight.sign().detach_() * self.scale
         elif self.algo == 'sign_symmetry_random_magnitude':
@@ -44,7 +87,8 @@ class AsymmetricFeedbackLinear(nn.Linear):
         else:
             raise RuntimeError('unsupported algorithm for %s' % self.__class__.__name__)
 
-        return AsymmetricFeedbackLinearFunc.apply(input, self.weight, feedback_weight, self.bias)
+        return AsymmetricFeedbackLinearFunc.apply(
+            input, self.weight, feedback_weight, self.bias, self.saved_input_format)
 
 
 
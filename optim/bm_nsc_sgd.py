@@ -1,22 +1,38 @@
 """
 Slight modification of torch.optim.SGD
     - `d_p = p.grad.data` is replaced by `d_p = p.grad.data.sign()` in `step()` to implement batch manhattan
+    - optional no sign change: weights that would change sign are set to +/- lower_bound instead
+    - optional LARS layer-wise trust ratio (You, Gitman, & Ginsburg, 2017, arXiv:1708.03888) for large-batch
+        training: the update of each weight tensor is scaled by
+        trust_coefficient * ||w|| / (||d_p|| + weight_decay * ||w||), where d_p is the (batch manhattan) gradient;
+        1-D parameters (biases & batch-norm parameters) are excluded
+    - optional momentum buffers in bf16 or fp16 with stochastic rounding (see optim/stochastic_rounding.py)
+    - optional statistics of the steps (prevented sign flips, clamped weights, update norms; see optim/step_stats.py)
+        per param group, returned by step_stats()
 """
 
 import torch
 from torch.optim.optimizer import Optimizer, required
 
+from optim.step_stats import StepStats
+from optim.stochastic_rounding import MOMENTUM_FORMATS, MomentumRounding
+
 
 class BMNSC_SGD(Optimizer):
     def __init__(self, params, lr=required, momentum=0, dampening=0,
                  weight_decay=0, nesterov=False,
-                 batch_manhattan=False, no_sign_change=False, lower_bound=1e-10):
+                 batch_manhattan=False, no_sign_change=False, lower_bound=1e-10, trust_coefficient=0,
+                 momentum_format=None, momentum_seed=0, track_stats=False):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
             raise ValueError("Invalid momentum value: {}".format(momentum))
         if weight_decay < 0.0:
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
+        if trust_coefficient < 0.0:
+            raise ValueError("Invalid trust_coefficient value: {}".format(trust_coefficient))
+        if momentum_format not in MOMENTUM_FORMATS:
+            raise ValueError("Invalid momentum_format value: {}".format(momentum_format))
         batch_manhattan = bool(batch_manhattan)
         no_sign_change = bool(no_sign_change)
         lower_bound = abs(float(lower_bound))
@@ -24,22 +40,43 @@ class BMNSC_SGD(Optimizer):
         defaults = dict(lr=lr, momentum=momentum, dampening=dampening,
                         weight_decay=weight_decay, nesterov=nesterov,
                         batch_manhattan=batch_manhattan, no_sign_change=no_sign_change,
-                        lower_bound=lower_bound)
+                        lower_bound=lower_bound, trust_coefficient=trust_coefficient,
+                        momentum_format=momentum_format)
         if nesterov and (momentum <= 0 or dampening != 0):
             raise ValueError("Nesterov momentum requires a momentum and zero dampening")
         super().__init__(params, defaults)
+        self.momentum_seed = momentum_seed
+        self._momentum_rounding = {}
+        self._stats = StepStats() if track_stats else None
 
     def __setstate__(self, state):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault('nesterov', False)
+            group.setdefault('trust_coefficient', 0)
+            group.setdefault('momentum_format', None)
+        self.__dict__.setdefault('momentum_seed', 0)
+        self.__dict__.setdefault('_stats', None)
+        self._momentum_rounding = {}
+
+    def _rounding(self, momentum_format):
+        if momentum_format not in self._momentum_rounding:
+            self._momentum_rounding[momentum_format] = MomentumRounding(momentum_format, self.momentum_seed)
+        return self._momentum_rounding[momentum_format]
+
+    def step_stats(self, reset=True, process_group=None):
+        """Returns the statistics of the steps since the last reset per param group (see optim/step_stats.py),
+        keyed by the 'name' of the groups, or their index; requires track_stats"""
+        names = [group.get('name', i) for i, group in enumerate(self.param_groups)]
+        return self._stats.summary(names, reset, process_group)
 
     def step(self, closure=None):
         loss = None
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        index = 0
+        for group_index, group in enumerate(self.param_groups):
             weight_decay = group['weight_decay']
             momentum = group['momentum']
             dampening = group['dampening']
@@ -47,36 +84,67 @@ class BMNSC_SGD(Optimizer):
             bm = group['batch_manhattan']
             nsc = group['no_sign_change']
             lower_bound = group['lower_bound']
+            trust_coefficient = group['trust_coefficient']
+            momentum_format = group['momentum_format']
+            if self._stats is not None:
+                self._stats.step(group_index)
 
             for p in group['params']:
+                index += 1
                 if p.grad is None:
                     continue
                 d_p = p.grad.data
                 if bm:
                     d_p = d_p.sign_()    # single line change
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
+                w_norm = None
+                if trust_coefficient != 0 and p.dim() > 1:
+                    # LARS trust ratio, computed on the device without synchronizing
+                    w_norm = p.data.norm()
+                    g_norm = d_p.norm()
+                    trust_ratio = torch.where(
+                        (w_norm > 0) & (g_norm > 0),
+                        trust_coefficient * w_norm / (g_norm + weight_decay * w_norm),
+                        torch.ones_like(w_norm))
+                    if weight_decay != 0:
+                        d_p.add_(p.data, alpha=weight_decay)
+                    d_p.mul_(trust_ratio)
+                elif weight_decay != 0:
+                    d_p.add_(p.data, alpha=weight_decay)
+                if momentum != 0 and momentum_format is not None:
+                    buf = self._rounding(momentum_format).update(self.state[p], d_p, momentum, dampening, index)
+                    if nesterov:
+                        d_p = d_p.add(buf, alpha=momentum)
+                    else:
+                        d_p = buf
+                elif momentum != 0:
                     param_state = self.state[p]
                     if 'momentum_buffer' not in param_state:
                         buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
                         buf.mul_(momentum).add_(d_p)
                     else:
                         buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
+                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
                     if nesterov:
-                        d_p = d_p.add(momentum, buf)
+                        d_p = d_p.add(buf, alpha=momentum)
                     else:
                         d_p = buf
 
+                if self._stats is not None:
+                    update_sq = d_p.norm().square() * group['lr'] ** 2
+                    weight_sq = (p.data.norm() if w_norm is None else w_norm).square()
                 if nsc:
                     # added rountine for preventing sign change
                     pmask = p.data >= 0
-                    p_ori = torch.tensor(p.data)
-                p.data.add_(-group['lr'], d_p)
+                    p_ori = p.data.clone()
+                p.data.add_(d_p, alpha=-group['lr'])
                 if nsc:
                     flipmask = (p_ori.sign() * p.data.sign()) <= 0
                     p.data.masked_fill_(pmask & flipmask, lower_bound)
                     p.data.masked_fill_(~pmask & flipmask, -lower_bound)
+                if self._stats is not None:
+                    if nsc:
+                        self._stats.add(group_index, update_sq, weight_sq, flipmask, p.data, lower_bound)
+                    else:
+                        self._stats.add(group_index, update_sq, weight_sq)
 
         return loss
@@ -1,17 +1,26 @@
 """
 Slight modification of torch.optim.SGD
     - `d_p = p.grad.data` is replaced by `d_p = p.grad.data.sign()` in `step()` to implement batch manhattan
+    - optional momentum buffers in bf16 or fp16 with stochastic rounding (see optim/stochastic_rounding.py)
 """
 
+import torch
 import torch.optim
 
+from optim.stochastic_rounding import MomentumRounding
+
 
 class BMSGD(torch.optim.SGD):
+    def __init__(self, *args, momentum_format=None, momentum_seed=0, **kwargs):
+        super(BMSGD, self).__init__(*args, **kwargs)
+        self._momentum_rounding = None if momentum_format is None else MomentumRounding(momentum_format, momentum_seed)
+
     def step(self, closure=None):
         loss = None
         if closure is not None:
             loss = closure()
 
+        index = 0
         for group in self.param_groups:
             weight_decay = group['weight_decay']
             momentum = group['momentum']
@@ -19,24 +28,31 @@ class BMSGD(torch.optim.SGD):
             nesterov = group['nesterov']
 
             for p in group['params']:
+                index += 1
                 if p.grad is None:
                     continue
                 d_p = p.grad.data.sign()    # single line change
                 if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
+                    d_p.add_(p.data, alpha=weight_decay)
+                if momentum != 0 and self._momentum_rounding is not None:
+                    buf = self._momentum_rounding.update(self.state[p], d_p, momentum, dampening, index)
+                    if nesterov:
+                        d_p = d_p.add(buf, alpha=momentum)
+                    else:
+                        d_p = buf
+                elif momentum != 0:
                     param_state = self.state[p]
                     if 'momentum_buffer' not in param_state:
                         buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
                         buf.mul_(momentum).add_(d_p)
                     else:
                         buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
+                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
                     if nesterov:
-                        d_p = d_p.add(momentum, buf)
+                        d_p = d_p.add(buf, alpha=momentum)
                     else:
                         d_p = buf
 
-                p.data.add_(-group['lr'], d_p)
+                p.data.add_(d_p, alpha=-group['lr'])
 
         return loss
@@ -0,0 +1,22 @@
+"""
+Learning rate schedules of train.py, train_pipeline.py and train_last_layer.py
+    - step: the initial LR of each param group decayed by 10 every lr_decay epochs
+    - cosine: the initial LR decayed to 0 over all epochs following a half cosine, updated at every iteration
+    - optionally, the learning rate is ramped up linearly from 0 during the first warmup_epochs
+"""
+
+import math
+
+
+def adjust_learning_rate(optimizer, epoch, lr0s, iteration=0, iters_per_epoch=1, schedule='step', epochs=None,
+                         lr_decay=10, warmup_epochs=0):
+    """Sets the learning rate of the param groups of optimizer, whose initial learning rates are lr0s, for iteration
+    iteration of epoch epoch"""
+    progress = epoch + iteration / iters_per_epoch
+    warmup = min(1., (progress + 1. / iters_per_epoch) / warmup_epochs) if warmup_epochs > 0 else 1.
+    for param_group, lr0 in zip(optimizer.param_groups, lr0s):
+        if schedule == 'cosine':
+            lr = lr0 * 0.5 * (1 + math.cos(math.pi * progress / epochs))
+        else:
+            lr = lr0 * (0.1 ** (epoch // lr_decay))
+        param_group['lr'] = lr * warmup
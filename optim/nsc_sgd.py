@@ -1,53 +1,82 @@
 """
 Slight modification of torch.optim.SGD
     - `d_p = p.grad.data` is replaced by `d_p = p.grad.data.sign()` in `step()` to implement batch manhattan
+    - optional momentum buffers in bf16 or fp16 with stochastic rounding (see optim/stochastic_rounding.py)
+    - optional statistics of the steps (prevented sign flips, clamped weights, update norms; see optim/step_stats.py)
+        per param group, returned by step_stats()
 """
 
 import torch
 import torch.optim
 
+from optim.step_stats import StepStats
+from optim.stochastic_rounding import MomentumRounding
+
 
 class NSCSGD(torch.optim.SGD):
-    def __init__(self, *args, lbound=1e-10, **kwargs):
+    def __init__(self, *args, lbound=1e-10, momentum_format=None, momentum_seed=0, track_stats=False, **kwargs):
         super(NSCSGD, self).__init__(*args, **kwargs)
         self._lbound = abs(float(lbound))
+        self._momentum_rounding = None if momentum_format is None else MomentumRounding(momentum_format, momentum_seed)
+        self._stats = StepStats() if track_stats else None
+
+    def step_stats(self, reset=True, process_group=None):
+        """Returns the statistics of the steps since the last reset per param group (see optim/step_stats.py),
+        keyed by the 'name' of the groups, or their index; requires track_stats"""
+        names = [group.get('name', i) for i, group in enumerate(self.param_groups)]
+        return self._stats.summary(names, reset, process_group)
 
     def step(self, closure=None):
         loss = None
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        index = 0
+        for group_index, group in enumerate(self.param_groups):
             weight_decay = group['weight_decay']
             momentum = group['momentum']
             dampening = group['dampening']
             nesterov = group['nesterov']
+            if self._stats is not None:
+                self._stats.step(group_index)
 
             for p in group['params']:
+                index += 1
                 if p.grad is None:
                     continue
                 d_p = p.grad.data
                 if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
+                    d_p.add_(p.data, alpha=weight_decay)
+                if momentum != 0 and self._momentum_rounding is not None:
+                    buf = self._momentum_rounding.update(self.state[p], d_p, momentum, dampening, index)
+                    if nesterov:
+                        d_p = d_p.add(buf, alpha=momentum)
+                    else:
+                        d_p = buf
+                elif momentum != 0:
                     param_state = self.state[p]
                     if 'momentum_buffer' not in param_state:
                         buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
                         buf.mul_(momentum).add_(d_p)
                     else:
                         buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
+                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
                     if nesterov:
-                        d_p = d_p.add(momentum, buf)
+                        d_p = d_p.add(buf, alpha=momentum)
                     else:
                         d_p = buf
 
+                if self._stats is not None:
+                    update_sq = d_p.norm().square() * group['lr'] ** 2
+                    weight_sq = p.data.norm().square()
                 # added rountine for preventing sign change
                 pmask = p.data >= 0
-                p_ori = torch.tensor(p.data)
-                p.data.add_(-group['lr'], d_p)
+                p_ori = p.data.clone()
+                p.data.add_(d_p, alpha=-group['lr'])
                 flipmask = (p_ori.sign() * p.data.sign()) <= 0
                 p.data.masked_fill_(pmask & flipmask, self._lbound)
                 p.data.masked_fill_(~pmask & flipmask, -self._lbound)
+                if self._stats is not None:
+                    self._stats.add(group_index, update_sq, weight_sq, flipmask, p.data, self._lbound)
 
         return loss
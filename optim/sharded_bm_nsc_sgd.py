@@ -0,0 +1,34 @@
+"""
+BMNSC_SGD with its state sharded across data-parallel ranks (ZeRO stage 1, Rajbhandari et al., 2020,
+arXiv:1910.02054), built on torch.distributed.optim.ZeroRedundancyOptimizer
+    - the parameters of each param group are partitioned between ranks (greedily by size); each rank keeps the
+        momentum buffers of, and computes the update for, its own parameters only, then the updated parameters are
+        broadcast from their owners, so that all ranks hold the full model after step()
+    - batch manhattan, no sign change and LARS act on each parameter tensor independently, so the update of a
+        parameter does not depend on which rank computes it: training is the same as with BMNSC_SGD on every rank
+    - param groups (e.g. the learning rates set by adjust_learning_rate()) are shared by all ranks, as usual
+    - state_dict() is collective: it must be called on all ranks, gathers the state of all shards on rank 0 and
+        returns it there (in the format of BMNSC_SGD.state_dict(), so that checkpoints can be resumed with or without
+        sharding and with any number of ranks), and returns None on the other ranks
+    - step_stats() (with track_stats) is collective as well: the statistics of the shards are summed
+"""
+
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+from optim.bm_nsc_sgd import BMNSC_SGD
+
+
+class ShardedBMNSC_SGD(ZeroRedundancyOptimizer):
+    def __init__(self, params, process_group=None, **kwargs):
+        super(ShardedBMNSC_SGD, self).__init__(params, optimizer_class=BMNSC_SGD, process_group=process_group,
+                                               **kwargs)
+
+    def state_dict(self):
+        self.consolidate_state_dict(to=0)
+        # self.rank is the rank in the process group
+        if self.rank != 0:
+            return None
+        return super(ShardedBMNSC_SGD, self).state_dict()
+
+    def step_stats(self, reset=True):
+        return self.optim.step_stats(reset, self.process_group)
@@ -0,0 +1,82 @@
+"""
+Statistics of the steps of BMNSC_SGD and NSCSGD per param group, accumulated on the device
+    - flips_prevented: number of weights per step whose update would have changed their sign (or made them 0), and
+        which no sign change set to +/- lower_bound instead
+    - clamped_fraction: fraction of the weights of a no sign change group that are at +/- lower_bound (or 0) after a
+        step, averaged over steps
+    - update_norm: root mean square over steps of the norm of the update lr * d_p of the group (before no sign change)
+    - update_to_weight: ratio of the norms of the updates and of the weights (before the update) of the group, over the
+        steps
+    - the statistics are computed in the loop of step() from the tensors it already has (the update, the no sign
+        change masks) and accumulated into a tensor per group, on the device of its parameters, without
+        synchronizing; summary() copies them to the host, e.g. every --print-freq iterations
+"""
+
+import math
+
+import torch
+import torch.distributed as dist
+
+
+class StepStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # group index -> tensor of (flips prevented, clamped weights, squared update norm, squared weight norm)
+        self.totals = {}
+        # group index -> number of steps, number of weights of no sign change (over the steps)
+        self.steps = {}
+        self.nsc_weights = {}
+
+    def step(self, group_index):
+        """Called once per group at every step"""
+        self.steps[group_index] = self.steps.get(group_index, 0) + 1
+
+    def add(self, group_index, update_sq, weight_sq, flipmask=None, param=None, lower_bound=0.):
+        """Accumulates the squared norms of the update and weight of a parameter; with no sign change, also the
+        prevented sign flips (flipmask) and the weights of the updated param at +/- lower_bound"""
+        if flipmask is None:
+            zero = torch.zeros((), device=update_sq.device)
+            values = torch.stack([zero, zero, update_sq, weight_sq])
+        else:
+            values = torch.stack([flipmask.sum(), (param.abs() <= lower_bound).sum(), update_sq, weight_sq])
+            self.nsc_weights[group_index] = self.nsc_weights.get(group_index, 0) + param.numel()
+        total = self.totals.get(group_index)
+        if total is None:
+            self.totals[group_index] = values.double()
+        else:
+            total.add_(values)
+
+    def summary(self, names=None, reset=True, process_group=None):
+        """Returns {group name (default: index): statistics}; with a process group, the statistics of its processes
+        (e.g. holding shards of the parameters) are combined, which requires all of them to call summary()"""
+        indices = sorted(self.steps)
+        totals = [self.totals[i].cpu() if i in self.totals else torch.zeros(4, dtype=torch.double)
+                  for i in indices]
+        totals = torch.stack(totals) if indices else torch.zeros(0, 4, dtype=torch.double)
+        nsc_weights = torch.tensor([self.nsc_weights.get(i, 0) for i in indices], dtype=torch.double)
+        if process_group is not None:
+            # nccl only reduces CUDA tensors
+            combined = torch.cat([totals.flatten(), nsc_weights])
+            if dist.get_backend(process_group) == 'nccl':
+                combined = combined.cuda()
+            dist.all_reduce(combined, group=process_group)
+            combined = combined.cpu()
+            totals = combined[:totals.numel()].view(-1, 4)
+            nsc_weights = combined[totals.numel():]
+
+        summary = {}
+        for i, index in enumerate(indices):
+            flips, clamped, update_sq, weight_sq = totals[i].tolist()
+            steps = self.steps[index]
+            nsc = nsc_weights[i].item() > 0
+            summary[names[index] if names is not None else index] = {
+                'flips_prevented': flips / steps if nsc else None,
+                'clamped_fraction': clamped / nsc_weights[i].item() if nsc else None,
+                'update_norm': math.sqrt(update_sq / steps),
+                'update_to_weight': math.sqrt(update_sq / weight_sq) if weight_sq > 0 else 0.,
+            }
+        if reset:
+            self.reset()
+        return summary
@@ -0,0 +1,71 @@
+"""
+Momentum buffers kept in reduced precision with stochastic rounding, for BMNSC_SGD, BMSGD and NSCSGD
+    - with momentum_format 'bf16' or 'fp16', the momentum buffer of each parameter is stored in that format, which
+        halves the memory of the optimizer state; the momentum update and the parameter update are computed in fp32
+    - the updated buffer is rounded stochastically: up or down to one of the two nearest representable values, with
+        probabilities such that the rounded buffer is the fp32 buffer in expectation; with round-to-nearest, the small
+        increments (1 - dampening) * d_p would be lost once the buffer is much larger than them
+    - with batch manhattan, buffers are bounded by about (1 + weight_decay * |w|) / (1 - momentum), well within the
+        range of fp16
+    - the rounding noise is drawn from a generator seeded by (seed, parameter index, step of the parameter), so that
+        it is the same on all data-parallel ranks (which must keep identical parameters) and after resuming
+    - state dicts store the reduced-precision buffers; torch.optim.Optimizer.load_state_dict() casts them to the
+        dtype of the parameters, and they are rounded back at the next step
+"""
+
+import torch
+
+
+MOMENTUM_FORMATS = (None, 'bf16', 'fp16')
+_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def stochastic_round(value, dtype, generator=None):
+    """Returns fp32 tensor value rounded stochastically to dtype (torch.bfloat16 or torch.float16)"""
+    value = value.contiguous()
+    if dtype == torch.bfloat16:
+        # bf16 is the upper half of fp32: adding uniform noise to the lower 16 bits of the magnitude before
+        # truncating them rounds away from zero with probability (truncated bits) / 2 ** 16
+        noise = torch.randint(0, 2 ** 16, value.shape, dtype=torch.int32, device=value.device, generator=generator)
+        bits = value.view(torch.int32).add(noise).bitwise_and_(-2 ** 16)
+        return bits.view(torch.float32).to(torch.bfloat16)
+    nearest = value.to(dtype)
+    error = value - nearest.float()
+    # the other neighbour of value, on the side of the rounding error
+    other = torch.nextafter(nearest, torch.where(error > 0, float('inf'), float('-inf')).to(dtype))
+    probability = error.div_(other.float() - nearest.float()).nan_to_num_(0.)
+    uniform = torch.rand(value.shape, device=value.device, generator=generator)
+    return torch.where(uniform < probability, other, nearest)
+
+
+class MomentumRounding(object):
+    """Updates momentum buffers stored in momentum_format (see MOMENTUM_FORMATS), with stochastic rounding seeded
+    by seed"""
+
+    def __init__(self, momentum_format, seed=0):
+        assert momentum_format in MOMENTUM_FORMATS[1:], \
+            'momentum format {} is not supported'.format(momentum_format)
+        self.dtype = _DTYPES[momentum_format]
+        self.seed = seed
+        self.generators = {}
+
+    def _generator(self, device, index, step):
+        generator = self.generators.get(device)
+        if generator is None:
+            generator = self.generators[device] = torch.Generator(device)
+        # hashes of tuples of ints do not depend on the process
+        generator.manual_seed(hash((self.seed, index, step)) & (2 ** 63 - 1))
+        return generator
+
+    def update(self, param_state, d_p, momentum, dampening, index):
+        """Returns the updated momentum buffer of a parameter in fp32 and stores it rounded in
+        param_state['momentum_buffer']; index identifies the parameter in its optimizer"""
+        if 'momentum_buffer' not in param_state:
+            buf = d_p.to(torch.float32, copy=True)
+        else:
+            buf = param_state['momentum_buffer'].float().mul_(momentum).add_(d_p, alpha=1 - dampening)
+        # absent from buffers of fp32 checkpoints
+        param_state['rounding_step'] = param_state.get('rounding_step', 0) + 1
+        generator = self._generator(d_p.device, index, param_state['rounding_step'])
+        param_state['momentum_buffer'] = stochastic_round(buf, self.dtype, generator)
+        return buf
@@ -0,0 +1,152 @@
+"""
+Int8 post-training quantization of models trained with train.py, for CPU inference
+    - the asymmetric feedback model is first converted to a plain model with batch-norm folded
+        (models.fuse_for_inference)
+    - it is then quantized with FX graph mode static quantization, calibrated on batches of the validation set
+        (train.get_datasets)
+    - finally the fp32 (fused) and int8 models are evaluated on the validation set and their accuracy, CPU throughput
+        and size are reported
+Command line arguments follow train.py where applicable
+"""
+
+import argparse
+import io
+import time
+
+import torch
+import torch.utils.data
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import models
+from train import get_datasets, accuracy, AverageMeter
+
+parser = argparse.ArgumentParser(description='Int8 post-training quantization of asymmetric feedback models')
+parser.add_argument('data', metavar='DIR',
+                    help='path to dataset (or CIFAR)')
+parser.add_argument('checkpoint', metavar='PATH',
+                    help='path to checkpoint saved by train.py')
+parser.add_argument('--arch', '-a', metavar='ARCH', default=None,
+                    help='model architecture (default: the one stored in the checkpoint)')
+parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
+                    help='algorithm the model was trained with (default: sign_symmetry)')
+parser.add_argument('--last-layer-algo', '--lalgo', default='None', type=str, metavar='ALGO',
+                    help='algorithm the last layer was trained with (default: None)')
+parser.add_argument('--stem', default='auto', type=str, metavar='STEM',
+                    choices=('auto', 'cifar', 'imagenet'),
+                    help='stem the resnet was trained with; auto: cifar if data is CIFAR, imagenet otherwise ' +
+                         '(default: auto)')
+parser.add_argument('--calibration-batches', default=32, type=int, metavar='N',
+                    help='number of validation batches used for calibration (default: 32)')
+parser.add_argument('--eval-batches', default=-1, type=int, metavar='N',
+                    help='if set and > 0, number of validation batches used for the report (default: all)')
+parser.add_argument('--backend', default='x86', type=str, metavar='BACKEND',
+                    help='quantized engine: x86, fbgemm, onednn or qnnpack (default: x86)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 4)')
+parser.add_argument('-b', '--batch-size', default=64, type=int,
+                    metavar='N', help='mini-batch size (default: 64)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of CPU threads used for inference (default: torch default)')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='if set, saves the TorchScript int8 model to this path')
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.backends.quantized.engine = args.backend
+
+    # load & fuse fp32 model
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    arch = args.arch if args.arch is not None else checkpoint['arch']
+    print("=> loading asymmetric feedback model '{}' from '{}'".format(arch, args.checkpoint))
+    model_kwargs = dict(af_algo=args.algo, last_layer_af_algo=args.last_layer_algo)
+    if arch.startswith('resnet'):
+        model_kwargs['stem'] = models.resolve_stem(args.stem, args.data)
+    model = models.__dict__[arch](**model_kwargs)
+    models.load_checkpoint(model, checkpoint)
+    model.eval()
+
+    _, test_dataset = get_datasets(args.data)
+    val_loader = torch.utils.data.DataLoader(
+        test_dataset,
+        batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers)
+
+    example_input = next(iter(val_loader))[0]
+    fp32_model = models.fuse_for_inference(model, example_input=example_input)
+
+    # quantize
+    print('=> calibrating on {} validation batches'.format(args.calibration_batches))
+    int8_model = quantize(fp32_model, val_loader, args.calibration_batches, args.backend)
+
+    # report
+    print('=> evaluating fp32 model')
+    fp32_report = evaluate(fp32_model, val_loader, args.eval_batches)
+    print('=> evaluating int8 model')
+    int8_report = evaluate(int8_model, val_loader, args.eval_batches)
+    fp32_report['size'] = model_size(fp32_model)
+    int8_report['size'] = model_size(int8_model)
+
+    print('{:>6} {:>9} {:>9} {:>12} {:>10}'.format('', 'Prec@1', 'Prec@5', 'images/s', 'size (MB)'))
+    for label, report in (('fp32', fp32_report), ('int8', int8_report)):
+        print('{:>6} {:9.3f} {:9.3f} {:12.1f} {:10.2f}'.format(
+            label, report['top1'], report['top5'], report['throughput'], report['size'] / 2 ** 20))
+    print(' * int8 vs. fp32: Prec@1 {:+.3f}, throughput x{:.2f}, size x{:.2f}'.format(
+        int8_report['top1'] - fp32_report['top1'],
+        int8_report['throughput'] / fp32_report['throughput'],
+        int8_report['size'] / fp32_report['size']))
+
+    if args.output:
+        torch.jit.save(torch.jit.trace(int8_model, example_input), args.output)
+        print("=> saved int8 model to '{}'".format(args.output))
+
+
+def quantize(model, calibration_loader, calibration_batches, backend='x86'):
+    """Returns an int8 copy of the plain (fused) fp32 model, calibrated on calibration_batches batches"""
+    example_input = next(iter(calibration_loader))[0]
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example_input,))
+    with torch.no_grad():
+        for i, (input, _) in enumerate(calibration_loader):
+            if i >= calibration_batches:
+                break
+            prepared(input)
+    return convert_fx(prepared)
+
+
+def evaluate(model, val_loader, max_batches=-1):
+    """Returns top1, top5 and throughput (images per second of model compute time) of model on the CPU"""
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+    compute_time = 0.
+    n_images = 0
+
+    model.eval()
+    with torch.no_grad():
+        for i, (input, target) in enumerate(val_loader):
+            if 0 < max_batches <= i:
+                break
+            start = time.time()
+            output = model(input)
+            compute_time += time.time() - start
+            n_images += input.size(0)
+
+            prec1, prec5 = accuracy(output, target, topk=(1, 5))
+            top1.update(prec1[0].item(), input.size(0))
+            top5.update(prec5[0].item(), input.size(0))
+
+    print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'.format(top1=top1, top5=top5))
+    return {'top1': top1.avg, 'top5': top5.avg, 'throughput': n_images / compute_time}
+
+
+def model_size(model):
+    """Returns the size in bytes of the serialized state_dict of model"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+if __name__ == '__main__':
+    main()
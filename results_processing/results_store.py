@@ -0,0 +1,228 @@
+"""
+Indexed store of training runs and their learning curves, kept in a local SQLite database
+    - a run is either a log file (stdout of train.py, as in logs/) or a run directory (the --prefix of train.py)
+        containing the log (*.log, log or stdout), args.json written by train.py and checkpoints (*.pth.tar)
+    - ingestion is incremental: runs whose log & args.json are unchanged (size & mtime) since they were last
+        ingested are skipped, changed runs are re-ingested
+    - per-epoch metrics are the running averages of the last printed training iteration of the epoch and the
+        validation results of the epoch; if a run was resumed, the later values of an epoch replace the earlier ones
+    - curves are returned as NumPy arrays (runs x epochs, NaN-padded) for plotting
+Usage:
+    python results_store.py ingest results.sqlite logs/ /path/to/run/dirs/...
+    python results_store.py list results.sqlite [--algo ALGO] [--arch ARCH]
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+
+METRICS = ('train_loss', 'train_top1', 'train_top5', 'val_top1', 'val_top5')
+CONFIG_COLUMNS = ('arch', 'algo', 'last_layer_algo', 'lr', 'llr', 'batch_size',
+                  'batch_manhattan', 'last_layer_batch_manhattan', 'no_sign_change', 'last_layer_no_sign_change')
+LOG_NAMES = ('*.log', 'log', 'stdout')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    signature TEXT NOT NULL,
+    config TEXT NOT NULL,
+    {config_columns}
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    epoch INTEGER NOT NULL,
+    {metric_columns},
+    PRIMARY KEY (run_id, epoch)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checkpoints (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_algo ON runs (algo, last_layer_algo, arch);
+CREATE INDEX IF NOT EXISTS checkpoints_run ON checkpoints (run_id);
+'''.format(config_columns=',\n    '.join(CONFIG_COLUMNS),
+           metric_columns=',\n    '.join(m + ' REAL' for m in METRICS))
+
+_CREATE_RE = re.compile(r"=> creating (?:asymmetric feedback|reference) model '([^']+)'"
+                        r"(?: with non-last layer af_algo '([^']+)' and last layer af_algo '([^']+)')?")
+_LR_RE = re.compile(r'^(non-last|last) layer\(s\): lr = ([0-9.e+-]+)(.*)$')
+_TRAIN_RE = re.compile(r'^Epoch: \[(\d+)\]\[\d+/\d+\].*Loss [0-9.naif]+ \(([0-9.naif]+)\)\s+'
+                       r'Prec@1 [0-9.]+ \(([0-9.]+)\)\s+Prec@5 [0-9.]+ \(([0-9.]+)\)')
+_VAL_RE = re.compile(r'^ \* Prec@1 ([0-9.]+) Prec@5 ([0-9.]+)')
+
+
+def parse_log(path):
+    """Returns (config, {epoch: {metric: value}}) parsed from a train.py log"""
+    config = {}
+    epochs = {}
+    epoch = None
+    with open(path) as f:
+        for line in f:
+            match = _TRAIN_RE.match(line)
+            if match:
+                epoch = int(match.group(1))
+                epochs.setdefault(epoch, {}).update(zip(
+                    ('train_loss', 'train_top1', 'train_top5'), map(float, match.groups()[1:])))
+                continue
+            match = _VAL_RE.match(line)
+            if match:
+                if epoch is not None:
+                    epochs.setdefault(epoch, {}).update(val_top1=float(match.group(1)), val_top5=float(match.group(2)))
+                continue
+            match = _CREATE_RE.search(line)
+            if match:
+                config['arch'] = match.group(1)
+                config['algo'] = match.group(2) or 'None'
+                config['last_layer_algo'] = match.group(3) or 'None'
+                continue
+            match = _LR_RE.match(line)
+            if match:
+                prefix = 'last_layer_' if match.group(1) == 'last' else ''
+                config['llr' if prefix else 'lr'] = float(match.group(2))
+                config[prefix + 'batch_manhattan'] = 'Batch Manhattan' in match.group(3)
+                config[prefix + 'no_sign_change'] = 'No-sign-change' in match.group(3)
+    return config, epochs
+
+
+def find_runs(root):
+    """Returns {run path: (log path or None, args.json path or None, [checkpoint paths])} for all runs under root"""
+    runs = {}
+    if os.path.isfile(root):
+        return {root: (root, None, [])}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        logs = sorted(set(p for name in LOG_NAMES for p in glob.glob(os.path.join(glob.escape(dirpath), name))))
+        args_path = os.path.join(dirpath, 'args.json')
+        if logs or 'args.json' in filenames:
+            checkpoints = sorted(glob.glob(os.path.join(glob.escape(dirpath), '*.pth.tar')))
+            runs[dirpath] = (logs[-1] if logs else None, args_path if 'args.json' in filenames else None,
+                             checkpoints)
+        elif dirpath == root:
+            # a directory of log files, one per run, like logs/
+            for name in sorted(filenames):
+                if not name.startswith('.'):
+                    path = os.path.join(dirpath, name)
+                    runs[path] = (path, None, [])
+    return runs
+
+
+def _signature(paths):
+    stats = [os.stat(p) for p in paths if p is not None]
+    return json.dumps([(s.st_size, s.st_mtime_ns) for s in stats])
+
+
+class ResultsStore(object):
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, *roots):
+        """Indexes all runs under roots; returns the numbers of (ingested, skipped) runs"""
+        ingested = skipped = 0
+        signatures = dict(self.connection.execute('SELECT path, signature FROM runs'))
+        with self.connection:
+            for root in roots:
+                for run_path, (log_path, args_path, checkpoints) in find_runs(root).items():
+                    run_path = os.path.abspath(run_path)
+                    signature = _signature((log_path, args_path))
+                    if signatures.get(run_path) == signature:
+                        skipped += 1
+                        continue
+                    self._ingest_run(run_path, signature, log_path, args_path, checkpoints)
+                    ingested += 1
+        return ingested, skipped
+
+    def _ingest_run(self, run_path, signature, log_path, args_path, checkpoints):
+        config, epochs = parse_log(log_path) if log_path is not None else ({}, {})
+        if args_path is not None:
+            with open(args_path) as f:
+                config.update(json.load(f))
+        self.connection.execute('DELETE FROM runs WHERE path = ?', (run_path,))
+        cursor = self.connection.execute(
+            'INSERT INTO runs (path, signature, config, {}) VALUES (?, ?, ?, {})'.format(
+                ', '.join(CONFIG_COLUMNS), ', '.join('?' * len(CONFIG_COLUMNS))),
+            (run_path, signature, json.dumps(config)) + tuple(config.get(c) for c in CONFIG_COLUMNS))
+        run_id = cursor.lastrowid
+        self.connection.executemany(
+            'INSERT INTO epochs (run_id, epoch, {}) VALUES (?, ?, {})'.format(
+                ', '.join(METRICS), ', '.join('?' * len(METRICS))),
+            [(run_id, epoch) + tuple(metrics.get(m) for m in METRICS) for epoch, metrics in sorted(epochs.items())])
+        self.connection.executemany(
+            'INSERT INTO checkpoints (run_id, path) VALUES (?, ?)',
+            [(run_id, os.path.abspath(p)) for p in checkpoints])
+
+    def _where(self, filters):
+        unknown = set(filters) - set(CONFIG_COLUMNS) - {'path'}
+        if unknown:
+            raise ValueError('cannot filter runs by %s' % ', '.join(sorted(unknown)))
+        if not filters:
+            return '', ()
+        return ' WHERE ' + ' AND '.join('runs.%s = ?' % k for k in sorted(filters)), \
+            tuple(filters[k] for k in sorted(filters))
+
+    def runs(self, **filters):
+        """Returns a list of dicts (run_id, path, config, checkpoints) of runs matching filters on CONFIG_COLUMNS"""
+        where, params = self._where(filters)
+        rows = self.connection.execute(
+            'SELECT run_id, path, config FROM runs' + where + ' ORDER BY run_id', params).fetchall()
+        checkpoints = {}
+        for run_id, path in self.connection.execute('SELECT run_id, path FROM checkpoints'):
+            checkpoints.setdefault(run_id, []).append(path)
+        return [{'run_id': run_id, 'path': path, 'config': json.loads(config),
+                 'checkpoints': checkpoints.get(run_id, [])} for run_id, path, config in rows]
+
+    def curves(self, metric='val_top1', **filters):
+        """Returns (run_ids, curves) for runs matching filters, where curves[i, epoch] is metric of run run_ids[i]
+        at epoch, NaN where not recorded"""
+        if metric not in METRICS:
+            raise ValueError('unknown metric %s' % metric)
+        where, params = self._where(filters)
+        rows = self.connection.execute(
+            'SELECT epochs.run_id, epochs.epoch, epochs.{} FROM epochs JOIN runs USING (run_id){} '
+            'ORDER BY epochs.run_id'.format(metric, where), params).fetchall()
+        data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        run_ids, rows_index = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+        epochs = data[:, 1].astype(np.int64)
+        curves = np.full((len(run_ids), epochs.max() + 1 if len(epochs) else 0), np.nan)
+        curves[rows_index, epochs] = data[:, 2]
+        return run_ids, curves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Indexed store of training runs and learning curves')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='index runs (log files or run directories)')
+    ingest_parser.add_argument('db', help='path to the SQLite database (created if needed)')
+    ingest_parser.add_argument('roots', nargs='+', help='log files, directories of log files or run directories')
+    list_parser = subparsers.add_parser('list', help='list indexed runs with their best validation Prec@1')
+    list_parser.add_argument('db', help='path to the SQLite database')
+    for column in ('arch', 'algo', 'last_layer_algo'):
+        list_parser.add_argument('--' + column.replace('_', '-'), dest=column, default=None)
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == 'ingest':
+        ingested, skipped = store.ingest(*args.roots)
+        print('=> ingested {} runs, skipped {} unchanged runs'.format(ingested, skipped))
+    else:
+        filters = {c: getattr(args, c) for c in ('arch', 'algo', 'last_layer_algo') if getattr(args, c) is not None}
+        run_ids, curves = store.curves('val_top1', **filters)
+        best = dict(zip(run_ids.tolist(), np.nanmax(curves, axis=1).tolist() if curves.size else []))
+        for run in store.runs(**filters):
+            print('{:5d} {:8.3f} {}'.format(run['run_id'], best.get(run['run_id'], float('nan')), run['path']))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Sparse CPU inference of models trained with train.py --no-sign-change
+    - the weights pinned to +/- lower_bound by No-sign-change are counted per conv/linear layer
+        (models.pinned_weights_report) and pruned to exact zeros (models.prune_pinned_weights)
+    - the pruned model is converted to a plain model with batch-norm folded (models.fuse_for_inference), whose layers
+        are then replaced by structured (compacted channels) or unstructured (CSR) sparse variants where these are
+        faster on the CPU, as timed on a validation batch (models.sparsify_for_inference)
+    - finally the dense model (unpruned, fused) and the sparse model are evaluated on the validation set and their
+        accuracy, CPU throughput and per-layer latencies are reported
+Command line arguments follow train.py and quantize.py where applicable
+"""
+
+import argparse
+
+import torch
+import torch.utils.data
+
+import models
+from quantize import evaluate, model_size
+from train import get_datasets
+
+parser = argparse.ArgumentParser(description='Sparse inference from the weights pinned by No-sign-change')
+parser.add_argument('data', metavar='DIR',
+                    help='path to dataset (or CIFAR)')
+parser.add_argument('checkpoint', metavar='PATH',
+                    help='path to checkpoint saved by train.py')
+parser.add_argument('--arch', '-a', metavar='ARCH', default=None,
+                    help='model architecture (default: the one stored in the checkpoint)')
+parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
+                    help='algorithm the model was trained with (default: sign_symmetry)')
+parser.add_argument('--last-layer-algo', '--lalgo', default='None', type=str, metavar='ALGO',
+                    help='algorithm the last layer was trained with (default: None)')
+parser.add_argument('--stem', default='auto', type=str, metavar='STEM',
+                    choices=('auto', 'cifar', 'imagenet'),
+                    help='stem the resnet was trained with; auto: cifar if data is CIFAR, imagenet otherwise ' +
+                         '(default: auto)')
+parser.add_argument('--lower-bound', default=1e-10, type=float, metavar='LB',
+                    help='magnitude at which No-sign-change pins weights (default: 1e-10)')
+parser.add_argument('--min-speedup', default=1.1, type=float, metavar='X',
+                    help='minimum speedup of a sparse layer over the dense one for it to be used (default: 1.1)')
+parser.add_argument('--repeats', default=10, type=int, metavar='N',
+                    help='number of timed passes per layer variant (default: 10)')
+parser.add_argument('--eval-batches', default=-1, type=int, metavar='N',
+                    help='if set and > 0, number of validation batches used for the report (default: all)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 4)')
+parser.add_argument('-b', '--batch-size', default=64, type=int,
+                    metavar='N', help='mini-batch size (default: 64)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='number of CPU threads used for inference (default: torch default)')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='if set, saves the sparse model (pickled nn.Module) to this path')
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    arch = args.arch if args.arch is not None else checkpoint['arch']
+    print("=> loading asymmetric feedback model '{}' from '{}'".format(arch, args.checkpoint))
+    model_kwargs = dict(af_algo=args.algo, last_layer_af_algo=args.last_layer_algo)
+    if arch.startswith('resnet'):
+        model_kwargs['stem'] = models.resolve_stem(args.stem, args.data)
+    model = models.__dict__[arch](**model_kwargs)
+    models.load_checkpoint(model, checkpoint)
+    model.eval()
+
+    _, test_dataset = get_datasets(args.data)
+    val_loader = torch.utils.data.DataLoader(
+        test_dataset,
+        batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers)
+    example_input = next(iter(val_loader))[0]
+
+    # pinned weights
+    report = models.pinned_weights_report(model, args.lower_bound)
+    print('{:32s} {:>10s} {:>10s} {:>9s} {:>9s} {:>9s}'.format(
+        'layer', 'weights', 'pinned', 'sparsity', 'out ch.', 'in ch.'))
+    for layer in report:
+        print('{:32s} {:10d} {:10d} {:9.2%} {:9d} {:9d}'.format(
+            layer['name'], layer['weights'], layer['pinned'], layer['sparsity'],
+            layer['pinned_out_channels'], layer['pinned_in_channels']))
+    total_weights = sum(layer['weights'] for layer in report)
+    total_pinned = sum(layer['pinned'] for layer in report)
+    print(' * {} of {} conv/linear weights pinned ({:.2%})'.format(
+        total_pinned, total_weights, total_pinned / total_weights))
+
+    dense_model = models.fuse_for_inference(model, example_input=example_input)
+    models.prune_pinned_weights(model, args.lower_bound)
+    pruned_model = models.fuse_for_inference(model, example_input=example_input)
+    print('=> timing sparse variants of each layer')
+    sparse_model, layer_report = models.sparsify_for_inference(
+        pruned_model, example_input, min_speedup=args.min_speedup, repeats=args.repeats)
+    print('{:32s} {:>8s} {:>10s} {:>10s} {:>8s}'.format('layer', 'kernel', 'dense ms', 'ms', 'speedup'))
+    for layer in layer_report:
+        print('{:32s} {:>8s} {:10.3f} {:10.3f} {:8.2f}'.format(
+            layer['name'], layer['kind'], layer['dense_time'] * 1e3, layer['time'] * 1e3,
+            layer['dense_time'] / layer['time']))
+    print(' * conv/linear layers: {:.3f} ms dense, {:.3f} ms sparse per batch of {}'.format(
+        sum(layer['dense_time'] for layer in layer_report) * 1e3,
+        sum(layer['time'] for layer in layer_report) * 1e3, example_input.size(0)))
+
+    print('=> evaluating dense model')
+    dense_report = evaluate(dense_model, val_loader, args.eval_batches)
+    print('=> evaluating sparse model')
+    sparse_report = evaluate(sparse_model, val_loader, args.eval_batches)
+    dense_report['size'] = model_size(dense_model)
+    sparse_report['size'] = model_size(sparse_model)
+
+    print('{:>6} {:>9} {:>9} {:>12} {:>10}'.format('', 'Prec@1', 'Prec@5', 'images/s', 'size (MB)'))
+    for label, report in (('dense', dense_report), ('sparse', sparse_report)):
+        print('{:>6} {:9.3f} {:9.3f} {:12.1f} {:10.2f}'.format(
+            label, report['top1'], report['top5'], report['throughput'], report['size'] / 2 ** 20))
+    print(' * sparse vs. dense: Prec@1 {:+.3f}, throughput x{:.2f}, size x{:.2f}'.format(
+        sparse_report['top1'] - dense_report['top1'],
+        sparse_report['throughput'] / dense_report['throughput'],
+        sparse_report['size'] / dense_report['size']))
+
+    if args.output:
+        torch.save(sparse_model, args.output)
+        print("=> saved sparse model to '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,16 +11,39 @@ Modified from https://github.com/pytorch/examples/blob/master/imagenet/main.py
         - --learning-rate
         - --last-layer-learning-rate
         - --lr-decay
+        - --lr-schedule
+        - --warmup-epochs
+        - --lars
+        - --shard-optimizer
+        - --momentum-format
+        - --optimizer-stats
         - --save-every-epoch
         - --save-every-n-epochs
+        - --stem
+        - --saved-input-format
+        - --sign-feedback-format
+        - --meta-init
+        - --channels-last
+        - --concurrent-backward
+        - --workspace-pool
+        - --workspace-pool-max-mb
+        - --regenerate-feedback
+        - --prefetch-factor
+        - --prefetch-queue
+        - --checkpoint-every
+        - --resize-schedule
+        - --resize-batch
+    - Architectures other than resnets and alexnet are taken from torchvision and converted to asymmetric feedback
 Reference for training settings:
     - https://github.com/pytorch/examples/tree/master/imagenet
 """
 
 import argparse
+import json
 import os
 import random
 import shutil
+import sys
 import time
 import warnings
 
@@ -34,8 +57,17 @@ import torch.utils.data
 import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
+import torchvision.models
 
 from optim.bm_nsc_sgd import BMNSC_SGD
+from optim.lr_schedule import adjust_learning_rate
+from optim.sharded_bm_nsc_sgd import ShardedBMNSC_SGD
+from data.prefetcher import Prefetcher
+from data.resumable import ResumableSampler, SeededDataset
+from functional.concurrent_backward import set_concurrent_backward
+from functional.workspace import WorkspacePool
+from modules.af_conv2d_module import AsymmetricFeedbackConv2d
+from modules.af_linear_module import AsymmetricFeedbackLinear
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
@@ -63,12 +95,74 @@ parser.add_argument('--llr', '--last-layer-learning-rate', default=0.1, type=flo
                     metavar='LLR', help='initial learning rate')
 parser.add_argument('--lr-decay', '--lrd', default=10, type=int, metavar='LRD',
                     help='number of epochs after which lr is decreased 10x (default: 10)')
+parser.add_argument('--lr-schedule', default='step', type=str, metavar='SCHEDULE',
+                    choices=('step', 'cosine'),
+                    help='learning rate schedule, updated every iteration; options: step (decay 10x every ' +
+                         '--lr-decay epochs), cosine (decay to 0 at --epochs) (default: step)')
+parser.add_argument('--warmup-epochs', default=0, type=float, metavar='EPOCHS',
+                    help='number of epochs over which lr is linearly increased from 0, ' +
+                         'for large-batch training (default: 0)')
+parser.add_argument('--lars', default=0, type=float, metavar='ETA',
+                    help='if > 0, use LARS layer-wise trust ratios with this trust coefficient, ' +
+                         'for large-batch training (default: 0)')
+parser.add_argument('--shard-optimizer', dest='shard_optimizer', action='store_true',
+                    help='with distributed training, shard the momentum buffers & the optimizer update ' +
+                         'between processes (ZeRO stage 1); checkpoints are then written by rank 0 only')
+parser.add_argument('--momentum-format', default='None', type=str, metavar='FMT',
+                    choices=('None', 'bf16', 'fp16'),
+                    help='storage format of the momentum buffers, updated with stochastic rounding; ' +
+                         'options: None (fp32), bf16, fp16 (default: None)')
+parser.add_argument('--optimizer-stats', dest='optimizer_stats', action='store_true',
+                    help='accumulate statistics of the optimizer steps per param group (sign flips prevented by ' +
+                         'No-sign-change, clamped weights, update norms), printed every --print-freq iterations')
 parser.add_argument('--save-every-epoch', '--see', dest='save_every_epoch',
                     action='store_true', help='save every epoch ' +
                     '(each to a unique name to prevent overwriting)')
 parser.add_argument('--save-every-n-epochs', '--sene', default=-1, type=int, metavar='EPOCH',
                     help='if set and > 0, saves every n epochs '
                     '(each to a unique name to prevent overwriting)')
+parser.add_argument('--stem', default='auto', type=str, metavar='STEM',
+                    choices=('auto', 'cifar', 'imagenet'),
+                    help='stem of asymmetric feedback resnets; options: cifar (3x3 stride-1 conv1), ' +
+                         'imagenet (7x7 stride-2 conv1 + max pooling), auto (cifar if data is CIFAR, ' +
+                         'imagenet otherwise) (default: auto)')
+parser.add_argument('--saved-input-format', '--sif', default='None', type=str, metavar='FMT',
+                    choices=('None', 'bf16', 'int8'),
+                    help='storage format of the activations saved by asymmetric feedback layers ' +
+                         'for computing weight gradients; options: None, bf16, int8 (default: None)')
+parser.add_argument('--sign-feedback-format', '--sff', default='None', type=str, metavar='FMT',
+                    choices=('None', 'int8', 'bf16'),
+                    help='with sign_symmetry, storage format of the sign of the feedback weight, whose scale is ' +
+                         'applied after computing the input gradient; bf16 also computes the input gradient in ' +
+                         'bfloat16; options: None, int8, bf16 (default: None)')
+parser.add_argument('--meta-init', dest='meta_init', action='store_true',
+                    help='build asymmetric feedback model on the meta device and create its parameters once ' +
+                         'directly on the GPU (or from the checkpoint with --resume) for faster startup')
+parser.add_argument('--channels-last', dest='channels_last', action='store_true',
+                    help='run the model and its inputs in the channels_last memory format')
+parser.add_argument('--concurrent-backward', dest='concurrent_backward', action='store_true',
+                    help='on CPU, compute the input & weight gradients of asymmetric feedback layers concurrently, ' +
+                         'splitting the intra-op threads between them')
+parser.add_argument('--workspace-pool', dest='workspace_pool', action='store_true',
+                    help='reuse the buffers of sign_symmetry feedback weights across steps instead of ' +
+                         'allocating them at every step; hit rate and bytes reused are printed every epoch')
+parser.add_argument('--workspace-pool-max-mb', default=None, type=float, metavar='MB',
+                    help='maximum size of the buffers kept by --workspace-pool (default: the size of the ' +
+                         'weights of the asymmetric feedback layers, once per GPU)')
+parser.add_argument('--regenerate-feedback', dest='regenerate_feedback', action='store_true',
+                    help='with feedback_alignment, store only a seed per layer and regenerate the fixed random ' +
+                         'feedback weights in the backward pass instead of keeping them in memory')
+parser.add_argument('--checkpoint-every', '--ce', default=0, type=int, metavar='N',
+                    help='if > 0, also saves a checkpoint every N iterations within an epoch, ' +
+                         'from which --resume continues at the next batch (default: 0)')
+parser.add_argument('--resize-schedule', default='', type=str, metavar='SCHEDULE',
+                    help='progressive resizing: comma-separated EPOCH:SIZE pairs giving the training resolution ' +
+                         'from each epoch on, e.g. 0:128,40:192,70:224; the full resolution (224, or 32 for ' +
+                         'CIFAR) is used before the first listed epoch and without a schedule; validation always ' +
+                         'uses the full resolution (default: none)')
+parser.add_argument('--resize-batch', dest='resize_batch', action='store_true',
+                    help='with --resize-schedule, scales the batch size by (full resolution / resolution)^2 ' +
+                         'at lower resolutions, and the learning rates linearly with it')
 parser.add_argument('--prefix', metavar='DIR', default='.',
                     help='path to save files')
 
@@ -77,6 +171,11 @@ parser.add_argument('data', metavar='DIR',
 parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18')
 parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
+parser.add_argument('--prefetch-factor', default=2, type=int, metavar='N',
+                    help='number of batches loaded in advance by each worker (default: 2)')
+parser.add_argument('--prefetch-queue', default=2, type=int, metavar='N',
+                    help='number of batches copied to the GPU and normalized in advance by a background thread; ' +
+                         '0 disables the prefetcher (default: 2)')
 parser.add_argument('--epochs', default=90, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -109,9 +208,8 @@ best_prec1 = 0
 
 
 def main():
-    global args, best_prec1, lr_decay
+    global args, best_prec1
     args = parser.parse_args()
-    lr_decay = args.lr_decay
 
     os.makedirs(args.prefix, exist_ok=True)
     if args.algo == 'None':
@@ -137,8 +235,21 @@ def main():
     if args.distributed:
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size)
+    # run configuration & per-epoch metrics, indexed by results_processing/results_store.py; written by one process,
+    # the log is appended to on resume
+    if not args.distributed or dist.get_rank() == 0:
+        with open(os.path.join(args.prefix, 'args.json'), 'w') as f:
+            json.dump(vars(args), f, indent=1, sort_keys=True)
+        sys.stdout = Tee(sys.stdout, os.path.join(args.prefix, 'log'))
 
     # create model
+    resume_checkpoint = None
+    if args.concurrent_backward:
+        set_concurrent_backward(True)
+    workspace_pool = None
+    if args.workspace_pool:
+        max_bytes = None if args.workspace_pool_max_mb is None else int(args.workspace_pool_max_mb * 2 ** 20)
+        workspace_pool = WorkspacePool(max_bytes)
     if args.algo == 'None':
         if args.pretrained:
             print("=> using pre-trained reference model '{}'".format(args.arch))
@@ -147,17 +258,89 @@ def main():
             print("=> creating reference model '{}'".format(args.arch))
             model = models.__dict__[args.arch]()
     else:
-        assert args.arch.startswith('resnet') or args.arch.startswith('alexnet'),\
-            'only resnets or alexnet supported'
         if args.pretrained:
             raise ValueError(
                 "Using non-standard models but pretrained set to True")
         print("=> creating asymmetric feedback model '{}' ".format(args.arch) +
               "with non-last layer af_algo '{}' and last layer af_algo '{}'".
               format(args.algo, args.last_layer_algo))
-        model = models.__dict__[args.arch](
-            af_algo=args.algo, last_layer_af_algo=args.last_layer_algo
-        )
+        if args.arch.startswith('resnet'):
+            stem = models.resolve_stem(args.stem, args.data)
+            print("=> using {} stem".format(stem))
+
+            def build_model():
+                return models.__dict__[args.arch](
+                    af_algo=args.algo, last_layer_af_algo=args.last_layer_algo, stem=stem
+                )
+        elif args.arch.startswith('alexnet'):
+            def build_model():
+                return models.__dict__[args.arch](
+                    af_algo=args.algo, last_layer_af_algo=args.last_layer_algo
+                )
+        else:
+            # other architectures are taken from torchvision and converted layer by layer
+            def build_model():
+                return models.convert_to_asymmetric(
+                    torchvision.models.__dict__[args.arch](), args.algo, args.last_layer_algo)
+        if args.regenerate_feedback:
+            # switched before the model is materialized, so that seeds are taken from the checkpoint if resuming
+            build_af_model = build_model
+
+            def build_model():
+                model = build_af_model()
+                print("=> regenerating feedback_alignment feedback weights from per-layer seeds")
+                for m in model.modules():
+                    if isinstance(m, (AsymmetricFeedbackConv2d, AsymmetricFeedbackLinear)) and \
+                            m.algo == 'feedback_alignment':
+                        m.regenerate_feedback = True
+                        m.reset_feedback_weight()
+                return model
+        if args.meta_init:
+            # build on the meta device; parameters & buffers are then created once directly on the GPU,
+            # from the checkpoint if resuming
+            device = 'cuda' if args.gpu is None else 'cuda:%d' % args.gpu
+            model = models.build_on_meta(build_model)
+            if args.resume:
+                resume_checkpoint = load_resume_checkpoint(device)
+                models.materialize(model, device, resume_checkpoint['state_dict'])
+            else:
+                models.materialize(model, device)
+        else:
+            model = build_model()
+        if args.saved_input_format != 'None':
+            print("=> saving activations for backward in format '{}'".format(args.saved_input_format))
+            for m in model.modules():
+                if isinstance(m, (AsymmetricFeedbackConv2d, AsymmetricFeedbackLinear)):
+                    m.saved_input_format = args.saved_input_format
+        if workspace_pool is not None:
+            pooled_bytes = 0
+            for m in model.modules():
+                if isinstance(m, (AsymmetricFeedbackConv2d, AsymmetricFeedbackLinear)):
+                    m.workspace_pool = workspace_pool
+                    pooled_bytes += m.weight.numel() * m.weight.element_size()
+            if workspace_pool.max_bytes is None:
+                # one buffer of the size of its weight per layer, on each device the model is replicated on
+                workspace_pool.max_bytes = pooled_bytes * max(1, torch.cuda.device_count())
+            print("=> workspace pool of at most {:.1f} MB".format(workspace_pool.max_bytes / 2 ** 20))
+        if args.sign_feedback_format != 'None':
+            print("=> using sign_symmetry feedback in format '{}'".format(args.sign_feedback_format))
+            for m in model.modules():
+                if isinstance(m, (AsymmetricFeedbackConv2d, AsymmetricFeedbackLinear)) and m.algo == 'sign_symmetry':
+                    m.sign_feedback_format = args.sign_feedback_format
+
+    # last layer is found before wrapping the model, which does not copy its modules
+    if args.arch.startswith('resnet'):
+        model_last_layer = model.fc
+    elif args.arch.startswith('alexnet'):
+        model_last_layer = model.classifier[-1]
+    else:
+        model_last_layer = models.last_layer(model)[1]
+    model_last_named_parameters = list(model_last_layer.named_parameters())
+
+    if args.channels_last:
+        # parameters are converted in place, so model_last_named_parameters remain valid
+        print("=> using channels_last memory format")
+        model = model.to(memory_format=torch.channels_last)
 
     if args.gpu is not None:
         model = model.cuda(args.gpu)
@@ -171,41 +354,157 @@ def main():
         else:
             model = torch.nn.DataParallel(model).cuda()
 
-    if args.gpu is not None:
-        if args.arch.startswith('resnet'):
-            model_last_named_parameters = list(model.fc.named_parameters())
-        elif args.arch.startswith('alexnet'):
-            model_last_named_parameters = list(
-                model.classifier[-1].named_parameters())
-    else:
-        if args.arch.startswith('resnet'):
-            model_last_named_parameters = list(
-                model.module.fc.named_parameters())
-        elif args.arch.startswith('alexnet'):
-            if args.distributed:
-                model_last_named_parameters = list(
-                    model.module.classifier[-1].named_parameters())
-            else:
-                model_last_named_parameters = list(
-                    model.classifier[-1].named_parameters())
-
     model_last_parameters = [nparam[1]
                              for nparam in model_last_named_parameters]
     model_nonlast_named_parameters = \
         [nparam for nparam in model.named_parameters()
          if not any([nparam[1] is p_last for p_last in model_last_parameters])]
-    model_nonlast_parameters = [nparam[1]
-                                for nparam in model_nonlast_named_parameters]
 
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda(args.gpu)
+    param_groups, lrs = get_param_groups(args, model_nonlast_named_parameters, model_last_named_parameters)
+    momentum_format = None if args.momentum_format == 'None' else args.momentum_format
+    if args.shard_optimizer:
+        assert args.distributed, '--shard-optimizer requires distributed training'
+        print("=> sharding optimizer state between {} processes".format(dist.get_world_size()))
+        optimizer = ShardedBMNSC_SGD(param_groups, momentum=args.momentum,
+                                     weight_decay=args.weight_decay, trust_coefficient=args.lars,
+                                     momentum_format=momentum_format, track_stats=args.optimizer_stats)
+    else:
+        optimizer = BMNSC_SGD(param_groups, momentum=args.momentum,
+                              weight_decay=args.weight_decay, trust_coefficient=args.lars,
+                              momentum_format=momentum_format, track_stats=args.optimizer_stats)
+
+    # optionally resume from a checkpoint
+    checkpoint = None
+    start_iteration = 0
+    sampler_seed = args.seed if args.seed is not None else random.randrange(2 ** 31)
+    if args.resume:
+        if resume_checkpoint is None:
+            checkpoint = load_resume_checkpoint()
+            model.load_state_dict(checkpoint['state_dict'])
+        else:
+            # model was already materialized from the checkpoint
+            checkpoint = resume_checkpoint
+        args.start_epoch = checkpoint['epoch']
+        best_prec1 = checkpoint['best_prec1']
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        # intra-epoch checkpoints (see --checkpoint-every) continue at the next batch of the epoch
+        start_iteration = checkpoint.get('iteration', 0)
+        sampler_seed = checkpoint.get('sampler_seed', sampler_seed)
+        print("=> loaded checkpoint '{}' (epoch {}, iteration {})"
+              .format(args.resume, checkpoint['epoch'], start_iteration))
+
+    cudnn.benchmark = True
+
+    # Data loading code
+    # with the prefetcher, inputs are normalized after being copied to the device
+    use_prefetcher = args.prefetch_queue > 0
+    resolution, batch_size = get_epoch_resolution(args.start_epoch)
+    train_dataset, test_dataset = get_datasets(args.data, normalize=not use_prefetcher, train_size=resolution)
+
+    # shuffling & augmentation are determined by sampler_seed, so that training can resume from any batch
+    if args.distributed:
+        # the shards of the ranks only partition the dataset if they all shuffle it in the same order
+        seed_list = [sampler_seed]
+        dist.broadcast_object_list(seed_list, src=0)
+        sampler_seed = seed_list[0]
+        train_sampler = ResumableSampler(train_dataset, num_replicas=dist.get_world_size(),
+                                         rank=dist.get_rank(), seed=sampler_seed)
+    else:
+        train_sampler = ResumableSampler(train_dataset, seed=sampler_seed)
+    train_dataset = SeededDataset(train_dataset)
+
+    # workers are kept alive across epochs instead of being re-forked for every train and validation pass
+    loader_kwargs = dict(num_workers=args.workers, pin_memory=True)
+    if args.workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+
+    if use_prefetcher:
+        device = 'cuda' if args.gpu is None else 'cuda:%d' % args.gpu
+        mean, std = get_normalization(args.data)
+
+    def get_train_loader(batch_size):
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=batch_size,
+            sampler=train_sampler, **loader_kwargs)
+        if use_prefetcher:
+            train_loader = Prefetcher(train_loader, device, mean, std, args.prefetch_queue)
+        return train_loader
+
+    train_loader = get_train_loader(batch_size)
+
+    val_loader = torch.utils.data.DataLoader(
+        test_dataset,
+        batch_size=args.batch_size, shuffle=False,
+        **loader_kwargs)
+    if use_prefetcher:
+        val_loader = Prefetcher(val_loader, device, mean, std, args.prefetch_queue)
+
+    if args.evaluate:
+        validate(val_loader, model, criterion)
+        return
+
+    meters_state = None
+    if checkpoint is not None and start_iteration > 0:
+        set_rng_state(checkpoint['rng_state'])
+        meters_state = checkpoint['meters']
+    checkpoint = resume_checkpoint = None
+
+    for epoch in range(args.start_epoch, args.epochs):
+        # progressive resizing: the training resolution & batch size change at the epochs of --resize-schedule;
+        # the loader is recreated, as persistent workers keep their own copy of the dataset & its transform
+        if get_epoch_resolution(epoch) != (resolution, batch_size):
+            resolution, batch_size = get_epoch_resolution(epoch)
+            train_dataset.dataset.transform = get_train_transform(args.data, not use_prefetcher, resolution)
+            train_loader = get_train_loader(batch_size)
+        if args.resize_schedule:
+            print('=> epoch {}: training resolution {}, batch size {}'.format(epoch, resolution, batch_size))
+        train_sampler.set_epoch(epoch, start_iteration * batch_size)
+
+        # train for one epoch (learning rate is adjusted every iteration)
+        # learning rates are scaled linearly with the batch size (see --resize-batch)
+        epoch_lrs = [lr * batch_size / args.batch_size for lr in lrs]
+        train(train_loader, model, criterion, optimizer, epoch, epoch_lrs, sampler_seed, start_iteration,
+              meters_state)
+        start_iteration = 0
+        meters_state = None
+
+        # evaluate on validation set
+        prec1 = validate(val_loader, model, criterion)
+
+        if use_prefetcher:
+            print('=> train loader {}; validation loader {}'.format(train_loader.stats(), val_loader.stats()))
+        if workspace_pool is not None:
+            print('=> workspace pool {}'.format(workspace_pool.stats()))
+            # released between epochs, so that the buffers are not held while the loaders of a new
+            # --resize-schedule resolution are built; reallocated in the first step of the next epoch
+            workspace_pool.clear()
+            workspace_pool.reset_stats()
+
+        # remember best prec@1 and save checkpoint
+        is_best = prec1 > best_prec1
+        best_prec1 = max(prec1, best_prec1)
+        save_dict = {
+            'epoch': epoch + 1,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_prec1': best_prec1,
+            'optimizer': optimizer.state_dict(),
+            'sampler_seed': sampler_seed,
+        }
+        save_checkpoint(save_dict, is_best, epoch)
+
+
+def get_param_groups(args, nonlast_named_parameters, last_named_parameters):
+    """Returns (param_groups, initial learning rates) for BMNSC_SGD, with the learning rate, Batch Manhattan and
+    No-sign-change options of args for the non-last and last layer(s) (bias is excluded from No-sign-change)"""
     param_groups = []
     lrs = []
-    for use_bm, use_nsc, params, named_params, lr, label in zip(
+    for use_bm, use_nsc, named_params, lr, label in zip(
             (args.batch_manhattan, args.last_layer_batch_manhattan),
             (args.no_sign_change, args.last_layer_no_sign_change),
-            (model_nonlast_parameters, model_last_parameters),
-            (model_nonlast_named_parameters, model_last_named_parameters),
+            (nonlast_named_parameters, last_named_parameters),
             (args.lr, args.llr),
             ('non-last', 'last')
     ):
@@ -223,59 +522,90 @@ def main():
             paramss = [bias_params, nonbias_params]
             use_nscs = [False, True]
         else:
-            paramss = [params]
+            paramss = [[nparam[1] for nparam in named_params]]
             use_nscs = [False]
 
         for params_, use_nsc_ in zip(paramss, use_nscs):
             param_groups.append({
+                'name': label + (' non-bias' if use_nsc_ else ' bias' if use_nsc else ''),
                 'params': params_,
                 'lr': lr,
                 'batch_manhattan': use_bm,
                 'no_sign_change': use_nsc_,
             })
             lrs.append(lr)
-    optimizer = BMNSC_SGD(param_groups, momentum=args.momentum,
-                          weight_decay=args.weight_decay)
-
-    # optionally resume from a checkpoint
-    if args.resume:
-        resumefpath = os.path.join(args.prefix, args.resume)
-        if os.path.isfile(resumefpath):
-            print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(resumefpath)
-            args.start_epoch = checkpoint['epoch']
-            best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
-        else:
-            raise IOError("=> no checkpoint found at '{}'".format(args.resume))
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    normalize = transforms.Normalize(
-        mean=[0.485, 0.456, 0.406],
-        std=[0.229, 0.224, 0.225]
-    )
-    if args.data == 'CIFAR':
-        traindir = '/data/CIFAR/train'
-        valdir = '/data/CIFAR/val'
-        
-        transform_train = transforms.Compose([
+    return param_groups, lrs
+
+
+def load_resume_checkpoint(map_location=None):
+    resumefpath = os.path.join(args.prefix, args.resume)
+    if not os.path.isfile(resumefpath):
+        raise IOError("=> no checkpoint found at '{}'".format(args.resume))
+    print("=> loading checkpoint '{}'".format(args.resume))
+    return torch.load(resumefpath, map_location=map_location)
+
+
+def get_normalization(data):
+    """Returns the per-channel (mean, std) used to normalize inputs of data"""
+    if data == 'CIFAR':
+        return (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
+    return (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+
+
+def get_full_resolution(data):
+    """Returns the (validation) input resolution of data"""
+    return 32 if data == 'CIFAR' else 224
+
+
+def get_epoch_resolution(epoch):
+    """Returns the (training resolution, batch size) of epoch epoch, following --resize-schedule and --resize-batch"""
+    full_resolution = get_full_resolution(args.data)
+    resolution = full_resolution
+    if args.resize_schedule:
+        schedule = sorted(tuple(int(v) for v in item.split(':')) for item in args.resize_schedule.split(','))
+        for start_epoch, size in schedule:
+            if epoch >= start_epoch:
+                resolution = size
+    batch_size = args.batch_size
+    if args.resize_batch:
+        batch_size = int(args.batch_size * (full_resolution / resolution) ** 2)
+    return resolution, batch_size
+
+
+def get_train_transform(data, normalize=True, size=None):
+    """Returns the training transform of data, producing size x size inputs (default: the full resolution)"""
+    normalization = [transforms.Normalize(*get_normalization(data))] if normalize else []
+    if data == 'CIFAR':
+        # random crops of the padded image are done at the original resolution, then resized
+        resize = [] if size is None or size == 32 else [transforms.Resize(size)]
+        return transforms.Compose([
             transforms.RandomCrop(32, padding=4),
+        ] + resize + [
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
-            transforms.Normalize((0.4914, 0.4822, 0.4465),
-                                 (0.2023, 0.1994, 0.2010)),
-        ])
+        ] + normalization)
+    return transforms.Compose([
+        transforms.RandomResizedCrop(size or 224),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+    ] + normalization)
+
+
+def get_datasets(data, normalize=True, train_size=None):
+    """Returns the (train, validation) datasets for CIFAR (if data == 'CIFAR') or an ImageNet-style folder
+
+    If normalize is False, inputs are left unnormalized (e.g. to be normalized on the device by Prefetcher)
+    Training inputs are train_size x train_size (default: the full resolution, see get_train_transform())
+    """
+    normalization = [transforms.Normalize(*get_normalization(data))] if normalize else []
+    transform_train = get_train_transform(data, normalize, train_size)
+    if data == 'CIFAR':
+        traindir = '/data/CIFAR/train'
+        valdir = '/data/CIFAR/val'
 
         transform_test = transforms.Compose([
             transforms.ToTensor(),
-            transforms.Normalize((0.4914, 0.4822, 0.4465),
-                                 (0.2023, 0.1994, 0.2010)),
-        ])
+        ] + normalization)
 
         train_dataset = datasets.CIFAR10(
             traindir,
@@ -290,20 +620,13 @@ def main():
         )
 
     else:
-        traindir = os.path.join(args.data, 'train')
-        valdir = os.path.join(args.data, 'val')
-        transform_train = transforms.Compose([
-            transforms.RandomResizedCrop(224),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ])
+        traindir = os.path.join(data, 'train')
+        valdir = os.path.join(data, 'val')
         transform_test = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
-            normalize,
-        ])
+        ] + normalization)
 
         train_dataset = datasets.ImageFolder(
             traindir,
@@ -314,76 +637,46 @@ def main():
             transform_test
         )
 
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(
-            train_dataset)
-    else:
-        train_sampler = None
-
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler)
-
-    val_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
-
-    if args.evaluate:
-        validate(val_loader, model, criterion)
-        return
-
-    for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            train_sampler.set_epoch(epoch)
-        adjust_learning_rate(optimizer, epoch, lrs)
-
-        # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch)
-
-        # evaluate on validation set
-        prec1 = validate(val_loader, model, criterion)
-
-        # remember best prec@1 and save checkpoint
-        is_best = prec1 > best_prec1
-        best_prec1 = max(prec1, best_prec1)
-        save_dict = {
-            'epoch': epoch + 1,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_prec1': best_prec1,
-            'optimizer': optimizer.state_dict(),
-        }
-        save_checkpoint(save_dict, is_best, epoch)
+    return train_dataset, test_dataset
 
 
-def train(train_loader, model, criterion, optimizer, epoch):
+def train(train_loader, model, criterion, optimizer, epoch, lrs, sampler_seed, start_iteration=0, meters_state=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    losses = DeviceAverageMeter()
+    top1 = DeviceAverageMeter()
+    top5 = DeviceAverageMeter()
+    meters = {'loss': losses, 'top1': top1, 'top5': top5}
+    if meters_state is not None:
+        for name, meter in meters.items():
+            meter.load_state_dict(meters_state[name])
+    # when resuming mid-epoch, train_loader only yields the remaining batches
+    iters_per_epoch = start_iteration + len(train_loader)
 
     # switch to train mode
     model.train()
 
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    for i, (input, target) in enumerate(train_loader, start_iteration):
         # measure data loading time
         data_time.update(time.time() - end)
 
+        adjust_learning_rate(optimizer, epoch, lrs, i, iters_per_epoch, args.lr_schedule, args.epochs, args.lr_decay,
+                             args.warmup_epochs)
+
         if args.gpu is not None:
             input = input.cuda(args.gpu, non_blocking=True)
+        if args.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
         target = target.cuda(args.gpu, non_blocking=True)
 
         # compute output
         output = model(input)
         loss = criterion(output, target)
 
-        # measure accuracy and record loss
+        # measure accuracy and record loss (on the device; see DeviceAverageMeter)
         prec1, prec5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), input.size(0))
+        losses.update(loss, input.size(0))
         top1.update(prec1[0], input.size(0))
         top5.update(prec5[0], input.size(0))
 
@@ -397,21 +690,38 @@ def train(train_loader, model, criterion, optimizer, epoch):
         end = time.time()
 
         if i % args.print_freq == 0:
+            synchronize_meters(losses, top1, top5)
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
                   'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
                   'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
-                      epoch, i, len(train_loader), batch_time=batch_time,
+                      epoch, i, iters_per_epoch, batch_time=batch_time,
                       data_time=data_time, loss=losses, top1=top1, top5=top5))
+            if args.optimizer_stats:
+                print_optimizer_stats(optimizer)
+
+        if args.checkpoint_every > 0 and (i + 1) % args.checkpoint_every == 0 and i + 1 < iters_per_epoch:
+            save_intra_epoch_checkpoint(model, optimizer, epoch, i + 1, sampler_seed, meters)
+
+
+def print_optimizer_stats(optimizer):
+    """Prints the statistics of the optimizer steps since the last call, per param group"""
+    for name, stats in optimizer.step_stats().items():
+        line = '  {}: update norm {:.3e}, update/weight {:.3e}'.format(
+            name, stats['update_norm'], stats['update_to_weight'])
+        if stats['flips_prevented'] is not None:
+            line += ', sign flips prevented {:.1f}/step, clamped {:.4%}'.format(
+                stats['flips_prevented'], stats['clamped_fraction'])
+        print(line)
 
 
 def validate(val_loader, model, criterion):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    losses = DeviceAverageMeter()
+    top1 = DeviceAverageMeter()
+    top5 = DeviceAverageMeter()
 
     # switch to evaluate mode
     model.eval()
@@ -421,15 +731,17 @@ def validate(val_loader, model, criterion):
         for i, (input, target) in enumerate(val_loader):
             if args.gpu is not None:
                 input = input.cuda(args.gpu, non_blocking=True)
+            if args.channels_last:
+                input = input.contiguous(memory_format=torch.channels_last)
             target = target.cuda(args.gpu, non_blocking=True)
 
             # compute output
             output = model(input)
             loss = criterion(output, target)
 
-            # measure accuracy and record loss
+            # measure accuracy and record loss (on the device; see DeviceAverageMeter)
             prec1, prec5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), input.size(0))
+            losses.update(loss, input.size(0))
             top1.update(prec1[0], input.size(0))
             top5.update(prec5[0], input.size(0))
 
@@ -438,6 +750,7 @@ def validate(val_loader, model, criterion):
             end = time.time()
 
             if i % args.print_freq == 0:
+                synchronize_meters(losses, top1, top5)
                 print('Test: [{0}/{1}]\t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                       'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
@@ -446,14 +759,25 @@ def validate(val_loader, model, criterion):
                           i, len(val_loader), batch_time=batch_time, loss=losses,
                           top1=top1, top5=top5))
 
+        synchronize_meters(losses, top1, top5)
         print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
               .format(top1=top1, top5=top5))
 
     return top1.avg
 
 
+def is_checkpoint_writer():
+    # with --shard-optimizer, the optimizer state is only consolidated on rank 0
+    return not args.shard_optimizer or dist.get_rank() == 0
+
+
 def save_checkpoint(state, is_best, epoch, filename='checkpoint.pth.tar'):
-    torch.save(state, os.path.join(args.prefix, filename))
+    if not is_checkpoint_writer():
+        return
+    filename = os.path.join(args.prefix, filename)
+    # written to a temporary file first, so that a preemption while saving does not corrupt the last checkpoint
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
     if is_best:
         shutil.copyfile(filename, os.path.join(
             args.prefix, 'model_best.pth.tar'))
@@ -463,6 +787,65 @@ def save_checkpoint(state, is_best, epoch, filename='checkpoint.pth.tar'):
             args.prefix, 'epoch%03d.pth.tar' % epoch))
 
 
+def save_intra_epoch_checkpoint(model, optimizer, epoch, iteration, sampler_seed, meters,
+                                filename='checkpoint.pth.tar'):
+    """Saves the state after iteration batches of epoch epoch to the regular checkpoint file, so that --resume
+    continues from the next batch"""
+    state = {
+        'epoch': epoch,
+        'iteration': iteration,
+        'arch': args.arch,
+        'state_dict': model.state_dict(),
+        'best_prec1': best_prec1,
+        'optimizer': optimizer.state_dict(),
+        'sampler_seed': sampler_seed,
+        'rng_state': get_rng_state(),
+        'meters': {name: meter.state_dict() for name, meter in meters.items()},
+    }
+    if not is_checkpoint_writer():
+        return
+    filename = os.path.join(args.prefix, filename)
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def get_rng_state():
+    """Returns the states of the Python & torch RNGs of this process; data loading workers are seeded per sample
+    by SeededDataset, so their states need not be saved"""
+    return {
+        'python': random.getstate(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Tee(object):
+    """Writes to a stream and appends to a file"""
+
+    def __init__(self, stream, path):
+        self.stream = stream
+        # line buffered, so that the log of a running job is up to date
+        self.file = open(path, 'a', buffering=1)
+
+    def write(self, data):
+        self.stream.write(data)
+        self.file.write(data)
+
+    def flush(self):
+        self.stream.flush()
+        self.file.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -481,12 +864,59 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def state_dict(self):
+        return {'val': self.val, 'sum': self.sum, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.val = state['val']
+        self.sum = state['sum']
+        self.count = state['count']
+        self.avg = self.sum / self.count if self.count else 0
+
+
+class DeviceAverageMeter(AverageMeter):
+    """Computes and stores the average and current value of tensors without copying them to the host on update
+
+    The running sum is kept on the device of the values; val, sum and avg are only updated on the host by
+    synchronize(), so that recording a metric every iteration never stalls the compute stream
+    """
+
+    def reset(self):
+        super(DeviceAverageMeter, self).reset()
+        self._val = None
+        self._sum = None
+        self._base_sum = 0.
+
+    def update(self, val, n=1):
+        val = val.detach()
+        self._val = val
+        if self._sum is None:
+            self._sum = val.double() * n
+        else:
+            self._sum.add_(val, alpha=n)
+        self.count += n
+
+    def synchronize(self):
+        if self._sum is not None:
+            self.val, device_sum = torch.stack((self._val.double(), self._sum)).tolist()
+            self.sum = self._base_sum + device_sum
+            self.avg = self.sum / self.count
+
+    def state_dict(self):
+        self.synchronize()
+        return super(DeviceAverageMeter, self).state_dict()
+
+    def load_state_dict(self, state):
+        super(DeviceAverageMeter, self).load_state_dict(state)
+        # values recorded from now on are accumulated on the device on top of the loaded sum
+        self._val = self._sum = None
+        self._base_sum = self.sum
+
 
-def adjust_learning_rate(optimizer, epoch, lr0s):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    for param_group, lr0 in zip(optimizer.param_groups, lr0s):
-        lr = lr0 * (0.1 ** (epoch // lr_decay))
-        param_group['lr'] = lr
+def synchronize_meters(*meters):
+    """Copies the values of DeviceAverageMeters to the host; only called at print boundaries and at epoch end"""
+    for meter in meters:
+        meter.synchronize()
 
 
 def accuracy(output, target, topk=(1,)):
@@ -501,7 +931,7 @@ def accuracy(output, target, topk=(1,)):
 
         res = []
         for k in topk:
-            correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
 
@@ -0,0 +1,232 @@
+"""
+Training of last layers on the cached penultimate features of a frozen asymmetric feedback ResNet or AlexNet
+    - the backbone (e.g. from a train.py checkpoint, --resume) is run once over the training and validation sets, and
+        the inputs of its last layer are stored in memory-mapped files in --cache-dir (see data/feature_cache.py);
+        the cache is reused by later runs with the same data, architecture, algorithm and checkpoint
+    - training images are taken without augmentation (with the validation transform), as they are seen once
+    - then a last layer is trained from scratch on the cached features for every combination of the comma-separated
+        values of --last-layer-algo, --llr, --last-layer-batch-manhattan and --last-layer-no-sign-change, with
+        BMNSC_SGD and the last layer options of train.py; BatchNorm statistics and dropout of the backbone are those of
+        evaluation mode
+    - the validation accuracy of every configuration is printed in a table at the end, and appended to --results as
+        JSON lines
+Usage:
+    python train_last_layer.py --arch resnet18 --resume checkpoint.pth.tar --last-layer-algo None,sign_symmetry
+        --llr 0.1,0.01 --lbm 0,1 CIFAR
+Command line arguments follow train.py where applicable
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.utils.data
+
+import models
+from data.feature_cache import FEATURE_DTYPES, FeatureCache, cache_exists, extract_features
+from models.checkpoint import strip_parallel_prefix
+from modules.af_linear_module import AsymmetricFeedbackLinear
+from optim.bm_nsc_sgd import BMNSC_SGD
+from optim.lr_schedule import adjust_learning_rate
+from train import get_datasets, get_param_groups, accuracy, AverageMeter
+
+parser = argparse.ArgumentParser(description='Last layer training on cached features of a frozen backbone')
+parser.add_argument('data', metavar='DIR',
+                    help='path to dataset (or CIFAR)')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
+                    help='asymmetric feedback resnet or alexnet (default: resnet18)')
+parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
+                    help='algorithm for asymmetric feedback weight of the backbone (default: sign_symmetry)')
+parser.add_argument('--stem', default='auto', type=str, metavar='STEM',
+                    choices=('auto', 'cifar', 'imagenet'),
+                    help='stem of the resnet; auto: cifar if data is CIFAR, imagenet otherwise (default: auto)')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint of the backbone (default: none, i.e. a randomly initialized backbone)')
+parser.add_argument('--cache-dir', default='feature_cache', type=str, metavar='DIR',
+                    help='directory of the cached features (default: feature_cache)')
+parser.add_argument('--feature-format', default='fp16', type=str, metavar='FMT',
+                    choices=tuple(FEATURE_DTYPES),
+                    help='storage format of the cached features; options: fp16, fp32 (default: fp16)')
+parser.add_argument('--in-memory', dest='in_memory', action='store_true',
+                    help='read the cached features into memory instead of memory-mapping them')
+parser.add_argument('--last-layer-algo', '--lalgo', default='None', type=str, metavar='ALGO,...',
+                    help='comma-separated algorithms for the last layer (default: None)')
+parser.add_argument('--llr', '--last-layer-learning-rate', default='0.1', type=str, metavar='LLR,...',
+                    help='comma-separated initial learning rates of the last layer (default: 0.1)')
+parser.add_argument('--last-layer-batch-manhattan', '--lbm', default='0', type=str, metavar='0|1,...',
+                    help='comma-separated batch manhattan options (0 or 1) for the last layer (default: 0)')
+parser.add_argument('--last-layer-no-sign-change', '--lnsc', default='0', type=str, metavar='0|1,...',
+                    help='comma-separated no-sign-change options (0 or 1) for the last layer (default: 0)')
+parser.add_argument('--lr-decay', '--lrd', default=10, type=int, metavar='LRD',
+                    help='number of epochs after which lr is decreased 10x (default: 10)')
+parser.add_argument('--lr-schedule', default='step', type=str, metavar='SCHEDULE',
+                    choices=('step', 'cosine'),
+                    help='learning rate schedule, updated every iteration; options: step, cosine (default: step)')
+parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
+                    help='momentum')
+parser.add_argument('--weight-decay', '--wd', default=1e-4, type=float,
+                    metavar='W', help='weight decay (default: 1e-4)')
+parser.add_argument('--epochs', default=30, type=int, metavar='N',
+                    help='number of epochs of each last layer training (default: 30)')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    metavar='N', help='mini-batch size (default: 256)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers for the feature extraction (default: 4)')
+parser.add_argument('--device', default='cpu', type=str, metavar='DEVICE',
+                    choices=('cpu', 'cuda'),
+                    help='device (default: cpu)')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed for initializing and shuffling, identical for all configurations (default: 0)')
+parser.add_argument('--results', default='', type=str, metavar='PATH',
+                    help='file to which the results are appended as JSON lines (default: none)')
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    train_cache, val_cache = get_feature_caches(args, device)
+    print("=> {} training and {} validation features of size {}".format(
+        len(train_cache), len(val_cache), train_cache.num_features))
+
+    configs = list(itertools.product(
+        args.last_layer_algo.split(','),
+        [float(llr) for llr in args.llr.split(',')],
+        [bool(int(bm)) for bm in args.last_layer_batch_manhattan.split(',')],
+        [bool(int(nsc)) for nsc in args.last_layer_no_sign_change.split(',')]))
+    results = []
+    for algo, llr, bm, nsc in configs:
+        print("=> last layer af_algo '{}', llr {}, batch manhattan {}, no-sign-change {}".format(algo, llr, bm, nsc))
+        start = time.time()
+        prec1, prec5 = train_last_layer(args, train_cache, val_cache, algo, llr, bm, nsc, device)
+        results.append({'arch': args.arch, 'algo': args.algo, 'resume': args.resume, 'last_layer_algo': algo,
+                        'llr': llr, 'last_layer_batch_manhattan': bm, 'last_layer_no_sign_change': nsc,
+                        'epochs': args.epochs, 'prec1': prec1, 'prec5': prec5, 'time': time.time() - start})
+
+    print('{:24s} {:>8s} {:>4s} {:>4s} {:>8s} {:>8s} {:>8s}'.format(
+        'last layer algo', 'llr', 'bm', 'nsc', 'prec@1', 'prec@5', 'time'))
+    for result in results:
+        print('{:24s} {:8.0e} {:4d} {:4d} {:8.3f} {:8.3f} {:8.1f}'.format(
+            result['last_layer_algo'], result['llr'], result['last_layer_batch_manhattan'],
+            result['last_layer_no_sign_change'], result['prec1'], result['prec5'], result['time']))
+    if args.results:
+        with open(args.results, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+def get_feature_caches(args, device):
+    """Returns the (train, validation) FeatureCaches, extracting the features with the backbone if the cache is
+    missing or was made with other settings"""
+    os.makedirs(args.cache_dir, exist_ok=True)
+    prefix = os.path.join(args.cache_dir, args.arch)
+    settings = {'data': args.data, 'arch': args.arch, 'algo': args.algo, 'stem': args.stem,
+                'resume': os.path.abspath(args.resume) if args.resume else '',
+                'resume_mtime': os.path.getmtime(args.resume) if args.resume else None,
+                'feature_format': args.feature_format}
+    settings_path = prefix + '_settings.json'
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            cached_settings = json.load(f)
+    else:
+        cached_settings = None
+    if cached_settings != settings or not (cache_exists(prefix + '_train') and cache_exists(prefix + '_val')):
+        model = get_backbone(args).to(device)
+        if args.arch.startswith('alexnet'):
+            layer = model.classifier[-1]
+        else:
+            layer = model.fc
+        # training features are extracted without augmentation
+        train_dataset, val_dataset = get_datasets(args.data)
+        train_dataset.transform = val_dataset.transform
+        for split, dataset in (('train', train_dataset), ('val', val_dataset)):
+            print("=> extracting {} features to '{}'".format(split, prefix + '_' + split))
+            loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                                 num_workers=args.workers, pin_memory=True)
+            extract_features(model, layer, loader, prefix + '_' + split, args.feature_format, device)
+        with open(settings_path, 'w') as f:
+            json.dump(settings, f)
+    return (FeatureCache(prefix + '_train', args.in_memory), FeatureCache(prefix + '_val', args.in_memory))
+
+
+def get_backbone(args):
+    if args.arch.startswith('resnet'):
+        stem = models.resolve_stem(args.stem, args.data)
+        model = models.__dict__[args.arch](af_algo=args.algo, stem=stem)
+    elif args.arch.startswith('alexnet'):
+        model = models.__dict__[args.arch](af_algo=args.algo)
+    else:
+        raise ValueError('only asymmetric feedback resnets and alexnet are supported, not %s' % args.arch)
+    if args.resume:
+        # the last layer of the checkpoint (e.g. of another algorithm) is not needed
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        state_dict = strip_parallel_prefix(checkpoint.get('state_dict', checkpoint))
+        last_layer_name = models.last_layer(model)[0]
+        state_dict = {key: value for key, value in state_dict.items() if not key.startswith(last_layer_name + '.')}
+        result = model.load_state_dict(state_dict, strict=False)
+        # only the keys of the last layer may be missing; anything else would leave the backbone partly random
+        mismatched = [key for key in result.missing_keys + result.unexpected_keys
+                      if not key.startswith(last_layer_name + '.')]
+        if mismatched:
+            raise RuntimeError("checkpoint '{}' does not match the {} backbone: missing keys {}, unexpected keys {}"
+                               .format(args.resume, args.arch,
+                                       [key for key in result.missing_keys if key in mismatched],
+                                       [key for key in result.unexpected_keys if key in mismatched]))
+        print("=> loaded backbone from '{}'".format(args.resume))
+    return model
+
+
+def train_last_layer(args, train_cache, val_cache, algo, llr, bm, nsc, device):
+    """Trains a last layer from scratch on the cached features and returns its final validation (prec@1, prec@5)"""
+    torch.manual_seed(args.seed)
+    if algo == 'None':
+        layer = nn.Linear(train_cache.num_features, train_cache.num_classes)
+    else:
+        layer = AsymmetricFeedbackLinear(train_cache.num_features, train_cache.num_classes, algo=algo)
+    layer = layer.to(device)
+    layer_args = argparse.Namespace(batch_manhattan=False, last_layer_batch_manhattan=bm, no_sign_change=False,
+                                    last_layer_no_sign_change=nsc, lr=0., llr=llr)
+    param_groups, lrs = get_param_groups(layer_args, [], list(layer.named_parameters()))
+    # the group of the non-last layers is empty
+    lrs = [lr for group, lr in zip(param_groups, lrs) if group['params']]
+    param_groups = [group for group in param_groups if group['params']]
+    optimizer = BMNSC_SGD(param_groups, momentum=args.momentum, weight_decay=args.weight_decay)
+    criterion = nn.CrossEntropyLoss()
+    generator = torch.Generator().manual_seed(args.seed)
+
+    iters_per_epoch = math.ceil(len(train_cache) / args.batch_size)
+    for epoch in range(args.epochs):
+        losses = AverageMeter()
+        layer.train()
+        for i, (input, target) in enumerate(train_cache.batches(args.batch_size, True, generator, device)):
+            adjust_learning_rate(optimizer, epoch, lrs, i, iters_per_epoch, args.lr_schedule, args.epochs,
+                                 args.lr_decay)
+            loss = criterion(layer(input), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.update(loss.item(), input.size(0))
+        prec1, prec5 = validate(layer, val_cache, args.batch_size, device)
+        print('Epoch: [{0}]\tLoss {loss.avg:.4f}\tPrec@1 {1:.3f}\tPrec@5 {2:.3f}'.format(
+            epoch, prec1, prec5, loss=losses))
+    return prec1, prec5
+
+
+def validate(layer, cache, batch_size, device):
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+    layer.eval()
+    with torch.no_grad():
+        for input, target in cache.batches(batch_size, device=device):
+            prec1, prec5 = accuracy(layer(input), target, topk=(1, min(5, cache.num_classes)))
+            top1.update(prec1[0].item(), input.size(0))
+            top5.update(prec5[0].item(), input.size(0))
+    return top1.avg, top5.avg
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Pipeline-parallel training of asymmetric feedback ResNets, one process per stage (see models/pipeline.py)
+    - launched with torchrun, or any launcher setting the torch.distributed environment variables (MASTER_ADDR,
+        MASTER_PORT, RANK, WORLD_SIZE), with one process per stage on one or several machines, e.g.
+            torchrun --nproc_per_node 4 train_pipeline.py --arch resnet152 --micro-batches 8 /path/to/imagenet
+    - every process builds the full model from the same seed and keeps its stage: the stem & the first residual
+        blocks on rank 0, ..., the last blocks & the fc layer on the last rank
+    - rank 0 loads the data and sends the targets to the last rank, which computes the loss & accuracy
+    - each stage steps its own BMNSC_SGD, with the non-last / last layer options of train.py (the last layer is on the
+        last stage)
+    - checkpoints are gathered on rank 0 and saved with the state_dict of the full model (loadable by
+        models.load_checkpoint) and the optimizer state of each stage, from which --resume continues
+Command line arguments follow train.py where applicable
+"""
+
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.utils.data
+
+import models
+from optim.bm_nsc_sgd import BMNSC_SGD
+from optim.lr_schedule import adjust_learning_rate
+from train import get_datasets, get_param_groups, accuracy, AverageMeter
+
+parser = argparse.ArgumentParser(description='Pipeline-parallel training of asymmetric feedback ResNets')
+parser.add_argument('data', metavar='DIR',
+                    help='path to dataset (or CIFAR)')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet152',
+                    help='asymmetric feedback resnet (default: resnet152)')
+parser.add_argument('--algo', default='sign_symmetry', type=str, metavar='ALGO',
+                    help='algorithm for asymmetric feedback weight (default: sign_symmetry)')
+parser.add_argument('--last-layer-algo', '--lalgo', default='None', type=str, metavar='ALGO',
+                    help='algorithm for the last layer (default: None)')
+parser.add_argument('--stem', default='auto', type=str, metavar='STEM',
+                    choices=('auto', 'cifar', 'imagenet'),
+                    help='stem of the resnet; auto: cifar if data is CIFAR, imagenet otherwise (default: auto)')
+parser.add_argument('--micro-batches', default=4, type=int, metavar='N',
+                    help='number of micro-batches each batch is split into (default: 4)')
+parser.add_argument('--schedule', default='1f1b', type=str, metavar='SCHEDULE',
+                    choices=('gpipe', '1f1b'),
+                    help='micro-batch schedule; options: gpipe (all forwards, then all backwards), 1f1b ' +
+                         '(alternating forwards & backwards after a warmup) (default: 1f1b)')
+parser.add_argument('--balance', default='', type=str, metavar='N,N,...',
+                    help='comma-separated number of residual blocks of each stage (default: as even as possible)')
+parser.add_argument('--device', default='cpu', type=str, metavar='DEVICE',
+                    choices=('cpu', 'cuda'),
+                    help='device of each stage; with cuda, the GPU of the local rank is used (default: cpu)')
+parser.add_argument('--dist-backend', default='gloo', type=str,
+                    help='distributed backend (default: gloo)')
+parser.add_argument('--batch-manhattan', '--bm', dest='batch_manhattan',
+                    action='store_true', help='use batch manhattan for non-last layers')
+parser.add_argument('--last-layer-batch-manhattan', '--lbm', dest='last_layer_batch_manhattan',
+                    action='store_true', help='use batch manhattan for last layer')
+parser.add_argument('--no-sign-change', '--nsc', dest='no_sign_change',
+                    action='store_true', help='use no-sign-change for non-last layers')
+parser.add_argument('--last-layer-no-sign-change', '--lnsc', dest='last_layer_no_sign_change',
+                    action='store_true', help='use no-sign-change for last layer')
+parser.add_argument('--lr', '--learning-rate', default=0.1, type=float,
+                    metavar='LR', help='initial learning rate')
+parser.add_argument('--llr', '--last-layer-learning-rate', default=0.1, type=float,
+                    metavar='LLR', help='initial learning rate of the last layer')
+parser.add_argument('--lr-decay', '--lrd', default=10, type=int, metavar='LRD',
+                    help='number of epochs after which lr is decreased 10x (default: 10)')
+parser.add_argument('--lr-schedule', default='step', type=str, metavar='SCHEDULE',
+                    choices=('step', 'cosine'),
+                    help='learning rate schedule, updated every iteration; options: step, cosine (default: step)')
+parser.add_argument('--lars', default=0, type=float, metavar='ETA',
+                    help='if > 0, use LARS layer-wise trust ratios with this trust coefficient (default: 0)')
+parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
+                    help='momentum')
+parser.add_argument('--weight-decay', '--wd', default=1e-4, type=float,
+                    metavar='W', help='weight decay (default: 1e-4)')
+parser.add_argument('--epochs', default=90, type=int, metavar='N',
+                    help='number of total epochs to run')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    metavar='N', help='mini-batch size (default: 256)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers of rank 0 (default: 4)')
+parser.add_argument('--print-freq', '-p', default=10, type=int,
+                    metavar='N', help='print frequency (default: 10)')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed for initializing the model, identical on all stages (default: 0)')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='path to latest checkpoint, relative to --prefix (default: none)')
+parser.add_argument('--prefix', metavar='DIR', default='.',
+                    help='path to save files')
+
+
+def main():
+    args = parser.parse_args()
+    dist.init_process_group(backend=args.dist_backend)
+    rank = dist.get_rank()
+    num_stages = dist.get_world_size()
+    if args.device == 'cuda':
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    # every stage builds the same full model and keeps its part
+    torch.manual_seed(args.seed)
+    stem = models.resolve_stem(args.stem, args.data)
+    model = models.__dict__[args.arch](af_algo=args.algo, last_layer_af_algo=args.last_layer_algo, stem=stem)
+    checkpoint = None
+    if args.resume:
+        checkpoint = torch.load(os.path.join(args.prefix, args.resume), map_location='cpu')
+        model.load_state_dict(checkpoint['state_dict'])
+    balance = [int(n) for n in args.balance.split(',')] if args.balance else None
+    module = models.partition_resnet(model, num_stages, balance)[rank].to(device)
+    stage = models.PipelineStage(module, rank, num_stages, device=device)
+    del model
+    print("=> rank {}: stage of {} modules, {} parameters".format(
+        rank, len(module), sum(p.numel() for p in module.parameters())))
+
+    named_parameters = models.stage_named_parameters(module)
+    last_named_parameters = [nparam for nparam in named_parameters if nparam[0].startswith('fc.')]
+    nonlast_named_parameters = [nparam for nparam in named_parameters if not nparam[0].startswith('fc.')]
+    param_groups, lrs = get_param_groups(args, nonlast_named_parameters, last_named_parameters)
+    # groups without parameters (e.g. the last layer on the other stages) are not given to the optimizer
+    lrs = [lr for group, lr in zip(param_groups, lrs) if group['params']]
+    param_groups = [group for group in param_groups if group['params']]
+    optimizer = BMNSC_SGD(param_groups, momentum=args.momentum,
+                          weight_decay=args.weight_decay, trust_coefficient=args.lars)
+    criterion = nn.CrossEntropyLoss()
+
+    start_epoch = 0
+    best_prec1 = 0
+    if checkpoint is not None:
+        # optimizer states are per stage, so they can only be restored with the same partition
+        if checkpoint['partition'] == (num_stages, args.balance):
+            optimizer.load_state_dict(checkpoint['stage_optimizers'][rank])
+        else:
+            print("=> rank {}: partition differs from the checkpoint's, optimizer state not restored".format(rank))
+        start_epoch = checkpoint['epoch']
+        best_prec1 = checkpoint['best_prec1']
+        checkpoint = None
+
+    # only rank 0 loads data; the other stages only need the number of batches
+    train_loader = val_loader = None
+    num_batches = [None, None]
+    if rank == 0:
+        train_dataset, test_dataset = get_datasets(args.data)
+        # full batches only, so that every batch can be split into micro-batches
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+            num_workers=args.workers, pin_memory=args.device == 'cuda')
+        val_loader = torch.utils.data.DataLoader(
+            test_dataset, batch_size=args.batch_size, shuffle=False,
+            num_workers=args.workers, pin_memory=args.device == 'cuda')
+        num_batches = [len(train_loader), len(val_loader)]
+    dist.broadcast_object_list(num_batches, src=0)
+
+    for epoch in range(start_epoch, args.epochs):
+        train(stage, train_loader, num_batches[0], criterion, optimizer, epoch, lrs, args)
+        prec1 = validate(stage, val_loader, num_batches[1], args)
+
+        # the validation result of the last stage is shared, so that all stages agree on the best model
+        prec1 = [prec1]
+        dist.broadcast_object_list(prec1, src=num_stages - 1)
+        prec1 = prec1[0]
+        is_best = prec1 > best_prec1
+        best_prec1 = max(prec1, best_prec1)
+        save_checkpoint(module, optimizer, epoch, best_prec1, is_best, args)
+
+
+def train(stage, train_loader, num_batches, criterion, optimizer, epoch, lrs, args):
+    batch_time = AverageMeter()
+    losses = AverageMeter()
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+
+    stage.module.train()
+    batches = iter(train_loader) if stage.is_first else None
+    end = time.time()
+    for i in range(num_batches):
+        adjust_learning_rate(optimizer, epoch, lrs, i, num_batches, args.lr_schedule, args.epochs, args.lr_decay)
+        input = target = None
+        if stage.is_first:
+            input, target = next(batches)
+            input = input.to(stage.device, non_blocking=True)
+            target = target.to(stage.device, non_blocking=True)
+
+        optimizer.zero_grad()
+        loss, output, target = stage.train_step(input, target, criterion, args.micro_batches, args.schedule)
+        optimizer.step()
+
+        batch_time.update(time.time() - end)
+        end = time.time()
+        if stage.is_last:
+            prec1, prec5 = accuracy(output, target, topk=(1, 5))
+            losses.update(loss.item(), target.size(0))
+            top1.update(prec1.item(), target.size(0))
+            top5.update(prec5.item(), target.size(0))
+            if i % args.print_freq == 0:
+                print('Epoch: [{0}][{1}/{2}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
+                      'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
+                          epoch, i, num_batches, batch_time=batch_time,
+                          loss=losses, top1=top1, top5=top5))
+
+
+def validate(stage, val_loader, num_batches, args):
+    """Returns the top-1 precision on the last stage, None on the other stages"""
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+
+    stage.module.eval()
+    batches = iter(val_loader) if stage.is_first else None
+    for i in range(num_batches):
+        input = target = None
+        if stage.is_first:
+            input, target = next(batches)
+            input = input.to(stage.device, non_blocking=True)
+            target = target.to(stage.device, non_blocking=True)
+        output, target = stage.forward_step(input, target)
+        if stage.is_last:
+            prec1, prec5 = accuracy(output, target, topk=(1, 5))
+            top1.update(prec1.item(), target.size(0))
+            top5.update(prec5.item(), target.size(0))
+
+    if stage.is_last:
+        print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'.format(top1=top1, top5=top5))
+        return top1.avg
+    return None
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.cpu()
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def save_checkpoint(module, optimizer, epoch, best_prec1, is_best, args):
+    """Gathers the state of all stages on rank 0, which saves it for the full model"""
+    states = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+    state = (models.stage_state_dict(module), optimizer.state_dict())
+    dist.gather_object(_to_cpu(state), states, dst=0)
+    if dist.get_rank() != 0:
+        return
+    state_dict = {}
+    for stage_state, _ in states:
+        state_dict.update(stage_state)
+    checkpoint = {
+        'epoch': epoch + 1,
+        'arch': args.arch,
+        'state_dict': state_dict,
+        'best_prec1': best_prec1,
+        'stage_optimizers': [optimizer_state for _, optimizer_state in states],
+        'partition': (len(states), args.balance),
+    }
+    filename = os.path.join(args.prefix, 'checkpoint.pth.tar')
+    torch.save(checkpoint, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    if is_best:
+        torch.save(checkpoint, os.path.join(args.prefix, 'model_best.pth.tar'))
+
+
+if __name__ == '__main__':
+    main()